@@ -0,0 +1,815 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import datastore
+import profiling
+
+# Bump whenever the layout of the saved cubes changes so old cubes are rebuilt
+CUBE_VERSION = 3
+NUM_HOURS = 24
+NUM_BUCKETS = datastore.NUM_BUCKETS
+NUM_CELLS = NUM_BUCKETS * NUM_HOURS
+
+# Frequency tables kept per bucket: table name -> the columns counted together
+TABLE_COLUMNS = {'start_station': ['Start Station'],
+                 'end_station': ['End Station'],
+                 'trip': ['Start Station', 'End Station'],
+                 'user_type': ['User Type'],
+                 'gender': ['Gender'],
+                 'birth_year': ['Birth Year'],
+                 # Not a column of the trips, see duration_buckets
+                 'duration_bucket': ['duration_bucket']}
+
+# Percentiles of the trip durations in the summaries
+QUANTILES = (0.5, 0.9, 0.99)
+# Relative error of the percentiles answered from the duration buckets
+SKETCH_ACCURACY = 0.01
+_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+
+
+def cell_ids(df):
+    """Get the (month, weekday, hour) cell of every trip as one integer.
+    INPUT:
+        df - dataframe of trips with the month and day_of_week columns
+    OUTPUTS:
+        cell (array) - ((month - 1) * 7 + weekday) * 24 + hour of the Start Time
+    """
+    month = df['month'].to_numpy(dtype=np.int64)
+    weekday = df['day_of_week'].cat.codes.to_numpy(dtype=np.int64)
+    hour = datastore.time_fields(df['Start Time'])[2].astype(np.int64)
+    return ((month - 1) * datastore.NUM_WEEKDAYS + weekday) * NUM_HOURS + hour
+
+
+def cell_dimensions(cell):
+    """Split cell ids back into their month (1 to 12), weekday (Monday is 0) and hour."""
+    cell = np.asarray(cell)
+    bucket, hour = np.divmod(cell, NUM_HOURS)
+    month, weekday = np.divmod(bucket, datastore.NUM_WEEKDAYS)
+    return month + 1, weekday, hour
+
+
+def trip_name(start, end):
+    """Get the 'start---end' name of a trip, NaN when a station is missing."""
+    if pd.isna(start) or pd.isna(end):
+        return np.nan
+    return start + '---' + end
+
+
+def frequency_frame(counts, label):
+    """Turn a series of counts into a dataframe, most frequent first.
+    INPUTS:
+        counts - Pandas Series of counts indexed by the counted values
+        label (str) - name of the column holding the counted values
+    OUTPUTS:
+        df - dataframe with the label and frequency columns
+    """
+    # Values that do not occur in the filtered data are counted as 0
+    counts = counts[counts > 0].sort_values(ascending=False, kind='mergesort')
+    return pd.DataFrame({label: np.asarray(counts.index, dtype=object), 'frequency': counts.to_numpy()})
+
+
+def percentile_name(quantile):
+    """Get the name of a quantile in the summaries, e.g. 'p99' for 0.99."""
+    return 'p{:g}'.format(quantile * 100)
+
+
+def duration_buckets(durations):
+    """Get the log bucket of every trip duration, see DurationSketch.
+
+    Durations under a second are counted as a second, missing ones have no bucket.
+    """
+    durations = np.asarray(durations, dtype=np.float64)
+    keys = np.ceil(np.log(np.maximum(durations, 1.0)) / np.log(_GAMMA))
+    # Nullable integers, the missing durations stay missing
+    return pd.Series(keys).astype('Int64').array
+
+
+class DurationSketch:
+    """Quantiles of trip durations from counts of logarithmic buckets.
+
+    Bucket k holds the durations in (gamma ** (k - 1), gamma ** k] and
+    answers for all of them the value 2 * gamma ** k / (gamma + 1), which is
+    within SKETCH_ACCURACY (relative) of every one of them, as in DDSketch.
+    The counts of disjoint sets of trips add up, so sketches of chunks,
+    months or cells merge exactly.
+    """
+
+    def __init__(self, counts):
+        # Series of the trip counts indexed by bucket
+        self.counts = counts[counts > 0].sort_index()
+
+    @classmethod
+    def from_durations(cls, durations):
+        keys = pd.Series(duration_buckets(durations)).dropna().to_numpy(dtype=np.int64)
+        return cls(pd.Series(keys).value_counts())
+
+    def merge(self, other):
+        """Get the sketch of the durations of both sketches."""
+        return DurationSketch(self.counts.add(other.counts, fill_value=0).astype(np.int64))
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def quantiles(self, quantiles=QUANTILES):
+        """Get the durations at quantiles (0 to 1) as a dict, e.g. {'p50': ..., 'p99': ...}.
+
+        The quantile q is the duration of rank q * (count - 1) counting from
+        the shortest trip, like numpy's 'lower' quantile.
+        """
+        if self.count == 0:
+            raise ValueError('No durations in the sketch')
+        cumulative = self.counts.to_numpy().cumsum()
+        ranks = np.floor(np.asarray(quantiles, dtype=np.float64) * (self.count - 1))
+        keys = self.counts.index.to_numpy()[np.searchsorted(cumulative, ranks, side='right')]
+        values = 2 * _GAMMA ** keys.astype(np.float64) / (_GAMMA + 1)
+        return {percentile_name(quantile): value for quantile, value in zip(quantiles, values)}
+
+
+def _codes(series):
+    # Categorical columns already are codes, encode the others
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy(), series.cat.categories
+    codes, uniques = pd.factorize(series, sort=True)
+    if pd.api.types.is_integer_dtype(uniques.dtype):
+        # Nullable integers (Birth Year), the uniques never hold a missing value
+        uniques = uniques.astype(np.int64)
+    return codes, pd.Index(uniques)
+
+
+def _labels(uniques, codes):
+    labels = np.asarray(uniques, dtype=object)[codes]
+    labels[codes < 0] = None
+    return labels
+
+
+def _encode(codes, levels):
+    # One integer key per combination of values: the positions of the values
+    # in the levels as the digits of a mixed radix number
+    key = np.zeros(len(codes[0]), dtype=np.int64)
+    for column_codes, level in zip(codes, levels):
+        key = key * max(len(level), 1) + column_codes
+    return key
+
+
+def _decode(keys, levels):
+    codes = []
+    for level in reversed(levels):
+        keys, column_codes = np.divmod(keys, max(len(level), 1))
+        codes.insert(0, column_codes)
+    return codes
+
+
+def _union_levels(level_lists):
+    # The sorted values of every column found in any of the tables
+    levels = []
+    for column_levels in zip(*level_lists):
+        level = column_levels[0]
+        for other in column_levels[1:]:
+            if not level.equals(other):
+                level = level.union(other)
+        levels.append(level)
+    return levels
+
+
+def _recode(keys, levels, new_levels):
+    # Keys of combinations of levels as keys of new_levels, a superset of
+    # them; sorted keys stay sorted
+    if all(level.equals(new_level) for level, new_level in zip(levels, new_levels)):
+        return keys
+    codes = _decode(keys, levels)
+    return _encode([new_level.get_indexer(level)[column_codes]
+                    for column_codes, level, new_level in zip(codes, levels, new_levels)], new_levels)
+
+
+def _frame_keys(df, columns):
+    # Keys of the trips with a value in every column, and the levels of the keys
+    codes, levels = zip(*(_codes(df[column]) for column in columns))
+    valid = np.ones(len(df), dtype=bool)
+    for column_codes in codes:
+        valid &= column_codes >= 0
+    return _encode([column_codes[valid] for column_codes in codes], levels), valid, list(levels)
+
+
+class CountTable:
+    """Trip counts by the values of one or more columns.
+
+    levels holds the sorted values of every column. A combination of values
+    is one integer key (see _encode), keys is sorted and counts[i] is the
+    number of trips of keys[i], so sorting by key is sorting by value.
+    """
+
+    def __init__(self, columns, levels, keys, counts):
+        self.columns = columns
+        self.levels = levels
+        self.keys = keys
+        self.counts = counts
+
+    @classmethod
+    def from_frame(cls, df, columns):
+        keys, _, levels = _frame_keys(df, columns)
+        keys, counts = np.unique(keys, return_counts=True)
+        return cls(columns, levels, keys, counts.astype(np.int64))
+
+    def merge(self, other):
+        """Get the counts of the trips of both tables."""
+        levels = _union_levels([self.levels, other.levels])
+        keys = np.concatenate([_recode(self.keys, self.levels, levels), _recode(other.keys, other.levels, levels)])
+        keys, position = np.unique(keys, return_inverse=True)
+        counts = np.bincount(position, weights=np.concatenate([self.counts, other.counts]), minlength=len(keys))
+        return CountTable(self.columns, levels, keys, counts.astype(np.int64))
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def _values(self, keys):
+        codes = _decode(keys, self.levels)
+        return [np.asarray(level)[column_codes] for level, column_codes in zip(self.levels, codes)]
+
+    def series(self):
+        """Get the counts as a Series indexed by the values (a MultiIndex for several columns)."""
+        values = self._values(self.keys)
+        if len(self.columns) == 1:
+            index = pd.Index(values[0], name=self.columns[0])
+        else:
+            index = pd.MultiIndex.from_arrays(values, names=self.columns)
+        return pd.Series(self.counts, index=index, name='count')
+
+    def top(self, n):
+        """Get the n most frequent values, most frequent first, ties in value order.
+        OUTPUTS:
+            top (list) - (values, count) pairs, values a tuple with one value per column
+        """
+        counts = self.counts
+        candidates = np.arange(len(counts))
+        if len(counts) > n:
+            # Every key counted at least as often as the n-th most frequent one
+            threshold = np.partition(counts, len(counts) - n)[len(counts) - n]
+            candidates = np.flatnonzero(counts >= threshold)
+        chosen = candidates[np.argsort(-counts[candidates], kind='stable')][:n]
+        values = self._values(self.keys[chosen])
+        return [(tuple(column[i] for column in values), counts[chosen[i]]) for i in range(len(chosen))]
+
+    def idxmax(self):
+        """Get the most frequent value (the first one in value order on ties), None without any."""
+        top = self.top(1)
+        if not top:
+            return None
+        values = top[0][0]
+        return values[0] if len(values) == 1 else values
+
+
+def _bucket_offsets(bucket):
+    return np.searchsorted(bucket, np.arange(NUM_BUCKETS + 1)).tolist()
+
+
+class BucketTable:
+    """Trip counts by the values of one or more columns per (month, weekday) bucket.
+
+    keys holds the sorted keys (see CountTable) found in any bucket. The
+    rows (codes into keys, counts) are sorted by bucket, the rows of
+    bucket b = (month - 1) * 7 + weekday are offsets[b] to offsets[b + 1],
+    like the rows of the columnar cache. Rolling up a month/day filter only
+    reads the rows of its buckets.
+    """
+
+    def __init__(self, columns, levels, keys, codes, counts, offsets):
+        self.columns = columns
+        self.levels = levels
+        self.keys = keys
+        self.codes = codes
+        self.counts = counts
+        self.offsets = offsets
+
+    @classmethod
+    def from_frame(cls, df, bucket, columns):
+        keys, valid, levels = _frame_keys(df, columns)
+        keys, codes = np.unique(keys, return_inverse=True)
+        # Bucket first, so the unique pairs come sorted by bucket
+        pairs, counts = np.unique(bucket[valid].astype(np.int64) * max(len(keys), 1) + codes,
+                                  return_counts=True)
+        pair_bucket, codes = np.divmod(pairs, max(len(keys), 1))
+        return cls(columns, levels, keys, codes.astype(np.int32), counts.astype(np.int32),
+                   _bucket_offsets(pair_bucket))
+
+    @classmethod
+    def combine(cls, tables):
+        """Get the counts of the trips of several tables.
+
+        The buckets found in one table only are copied as they are, the
+        counts are only added up in the buckets several tables share.
+        """
+        levels = _union_levels([table.levels for table in tables])
+        recoded = [_recode(table.keys, table.levels, levels) for table in tables]
+        keys = recoded[0]
+        for other in recoded[1:]:
+            keys = np.union1d(keys, other)
+        codes = [np.searchsorted(keys, table_keys)[table.codes] for table_keys, table in zip(recoded, tables)]
+
+        parts_codes, parts_counts, sizes = [], [], []
+        for b in range(NUM_BUCKETS):
+            parts = [(table_codes[table.offsets[b]:table.offsets[b + 1]], table.counts[table.offsets[b]:table.offsets[b + 1]])
+                     for table_codes, table in zip(codes, tables) if table.offsets[b + 1] > table.offsets[b]]
+            if len(parts) > 1:
+                both, position = np.unique(np.concatenate([part[0] for part in parts]), return_inverse=True)
+                summed = np.bincount(position, weights=np.concatenate([part[1] for part in parts]))
+                parts = [(both, summed.astype(np.int32))]
+            for bucket_codes, bucket_counts in parts:
+                parts_codes.append(bucket_codes)
+                parts_counts.append(bucket_counts)
+            sizes.append(sum(len(part[0]) for part in parts))
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).tolist()
+        empty = np.zeros(0, dtype=np.int32)
+        return cls(tables[0].columns, levels, keys, np.concatenate([empty] + parts_codes).astype(np.int32),
+                   np.concatenate([empty] + parts_counts).astype(np.int32), offsets)
+
+    def rollup(self, month=None, weekday=None):
+        """Add up the counts of the buckets of a month/day filter into a CountTable."""
+        ranges = datastore.bucket_ranges(self.offsets, month, weekday)
+        if len(ranges) == 1:
+            codes = self.codes[ranges[0][0]:ranges[0][1]]
+            counts = self.counts[ranges[0][0]:ranges[0][1]]
+        else:
+            codes = np.concatenate([self.codes[start:stop] for start, stop in ranges] + [self.codes[:0]])
+            counts = np.concatenate([self.counts[start:stop] for start, stop in ranges] + [self.counts[:0]])
+        summed = np.bincount(codes, weights=counts, minlength=len(self.keys))
+        present = summed > 0
+        return CountTable(self.columns, self.levels, self.keys[present], summed[present].astype(np.int64))
+
+    def arrays(self):
+        """The arrays of the table, for np.savez."""
+        arrays = {'columns': np.asarray(self.columns, dtype=str), 'keys': self.keys, 'codes': self.codes,
+                  'counts': self.counts, 'offsets': np.asarray(self.offsets, dtype=np.int64)}
+        for i, level in enumerate(self.levels):
+            # Text values as fixed width strings, np.load then needs no pickle
+            arrays['level{}'.format(i)] = level.to_numpy(dtype=str if level.dtype == object else None)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        columns = arrays['columns'].tolist()
+        levels = [pd.Index(arrays['level{}'.format(i)].tolist() if arrays['level{}'.format(i)].dtype.kind == 'U'
+                           else arrays['level{}'.format(i)]) for i in range(len(columns))]
+        return cls(columns, levels, arrays['keys'], arrays['codes'], arrays['counts'], arrays['offsets'].tolist())
+
+
+def _count_tables(df, bucket=None):
+    # CountTables of the trips, or BucketTables when the bucket of every trip is given
+    frames = {name: (df, columns) for name, columns in TABLE_COLUMNS.items()
+              if all(column in df.columns for column in columns)}
+    # The durations are counted by log bucket, the sketch of their percentiles
+    frames['duration_bucket'] = (pd.DataFrame({'duration_bucket': duration_buckets(df['Trip Duration'])}),
+                                 ['duration_bucket'])
+    if bucket is None:
+        return {name: CountTable.from_frame(frame, columns) for name, (frame, columns) in frames.items()}
+    return {name: BucketTable.from_frame(frame, bucket, columns) for name, (frame, columns) in frames.items()}
+
+
+def _first_rows(cell, values, extremes):
+    # First row of every cell holding the extreme value of its cell, extremes
+    # being a Series of those values indexed by the sorted cells
+    position = np.searchsorted(extremes.index.to_numpy(), cell)
+    rows = np.flatnonzero(values == extremes.to_numpy()[position])
+    return rows[np.unique(position[rows], return_index=True)[1]]
+
+
+def _cell_frame(df, cell):
+    """Trip count, duration moments and usage period of every cell."""
+    frame = pd.DataFrame({'cell': cell,
+                          'duration': df['Trip Duration'].to_numpy(),
+                          'start_time': df['Start Time'].to_numpy(),
+                          'end_time': df['End Time'].to_numpy()})
+    grouped = frame.groupby('cell')
+    cells = grouped.agg(count=('duration', 'size'),
+                        duration_sum=('duration', 'sum'),
+                        duration_min=('duration', 'min'),
+                        duration_max=('duration', 'max'),
+                        first_start=('start_time', 'min'),
+                        last_end=('end_time', 'max'))
+
+    # Stations of the longest and shortest trip of each cell
+    duration = frame['duration'].to_numpy()
+    for name, rows in (('longest', _first_rows(cell, duration, cells['duration_max'])),
+                       ('shortest', _first_rows(cell, duration, cells['duration_min']))):
+        for end, column in (('start', 'Start Station'), ('end', 'End Station')):
+            codes, uniques = _codes(df[column])
+            cells['{}_{}'.format(name, end)] = _labels(uniques, codes[rows])
+    return cells
+
+
+def _combine_cells(parts):
+    both = pd.concat(parts)
+    if both.index.is_unique:
+        # Disjoint cells (months of a city), nothing to add up
+        return both.sort_index()
+    grouped = both.groupby(level='cell')
+    cells = grouped.agg({'count': 'sum', 'duration_sum': 'sum',
+                         'duration_min': 'min', 'duration_max': 'max',
+                         'first_start': 'min', 'last_end': 'max'})
+    # Keep the stations of the part holding the longest (shortest) trip
+    for name, column, keep in (('longest', 'duration_max', 'last'),
+                               ('shortest', 'duration_min', 'first')):
+        extreme = both.sort_values(column, kind='mergesort')
+        extreme = extreme[~extreme.index.duplicated(keep=keep)]
+        for end in ('start', 'end'):
+            key = '{}_{}'.format(name, end)
+            cells[key] = extreme[key].reindex(cells.index)
+    return cells
+
+
+def _merge_tables(first, second):
+    tables = {}
+    for name in set(first) | set(second):
+        if name in first and name in second:
+            tables[name] = first[name].merge(second[name])
+        else:
+            tables[name] = first[name] if name in first else second[name]
+    return tables
+
+
+class TripAggregate:
+    """Mergeable statistics of a set of trips.
+
+    cells holds the trip count, duration moments (sum, min, max), first
+    start and last end times and the stations of the longest and shortest
+    trips per (month, weekday, hour) cell, for the time modes. tables holds
+    the trip counts by station, trip, user type, gender and year of birth
+    as CountTables. Aggregates of disjoint sets of trips (chunks of a file,
+    months of a city) merge into the aggregate of all of them.
+    """
+
+    def __init__(self, cells, tables):
+        self.cells = cells
+        self.tables = tables
+
+    @classmethod
+    def from_frame(cls, df):
+        """Aggregate a dataframe of trips (with the compact schema of datastore)."""
+        return cls(_cell_frame(df, cell_ids(df)), _count_tables(df))
+
+    def merge(self, other):
+        """Get the aggregate of the trips of both aggregates."""
+        return TripAggregate(_combine_cells([self.cells, other.cells]), _merge_tables(self.tables, other.tables))
+
+    def duration_sketch(self):
+        """Get the DurationSketch of the durations of the aggregated trips."""
+        return DurationSketch(self.tables['duration_bucket'].series())
+
+    def summary(self, num_stations=10):
+        """Get the statistics of the aggregated trips.
+        INPUTS:
+            num_stations (int) - number of most popular trips to keep
+        OUTPUTS:
+            summary (dict) - the same statistics as bikeshare.compute_summary,
+                the duration_percentiles within SKETCH_ACCURACY
+        """
+        cells = self.cells
+        if cells['count'].sum() == 0:
+            raise ValueError('No trips to summarise')
+        cell_month, cell_weekday, cell_hour = cell_dimensions(cells.index)
+        counts = cells['count']
+
+        month_counts = counts.groupby(cell_month).sum()
+        day_counts = counts.groupby(cell_weekday).sum()
+        summary = {'trip_count': int(counts.sum()),
+                   'popular_month': month_counts.idxmax(),
+                   'popular_month_count': month_counts.max(),
+                   'popular_day_of_week': datastore.WEEKDAY_NAMES[day_counts.idxmax()],
+                   'popular_hour': counts.groupby(cell_hour).sum().idxmax()}
+
+        summary['popular_start_station'] = self.tables['start_station'].idxmax()
+        summary['popular_end_station'] = self.tables['end_station'].idxmax()
+        # Most frequent first, ties in station order
+        trips = self.tables['trip'].top(num_stations)
+        summary['popular_trip'] = trip_name(*trips[0][0]) if trips else np.nan
+        summary['popular_trip_stations'] = trips[0][0] if trips else None
+        summary['popular_trips'] = pd.DataFrame({
+            'trips': [trip_name(start, end) for (start, end), _ in trips],
+            'frequency': np.array([count for _, count in trips], dtype=np.int64)})
+
+        total = cells['duration_sum'].sum()
+        longest = cells.iloc[cells['duration_max'].to_numpy().argmax()]
+        fastest = cells.iloc[cells['duration_min'].to_numpy().argmin()]
+        summary.update({'total_travel_time': total,
+                        'average_time': total / counts.sum(),
+                        'longest_trip_duration': longest['duration_max'],
+                        'fastest_trip_duration': fastest['duration_min'],
+                        'longest_trip': trip_name(longest['longest_start'], longest['longest_end']),
+                        'fastest_trip': trip_name(fastest['shortest_start'], fastest['shortest_end']),
+                        'duration_percentiles': self.duration_sketch().quantiles()})
+
+        summary.update({'user_types': frequency_frame(self.tables['user_type'].series(), 'user_types'),
+                        'earliest_usage': cells['first_start'].min(),
+                        'most_recent_usage': cells['last_end'].max()})
+
+        summary.update({'gender': None, 'popular_birth_year': None,
+                        'popular_birth_year_count': None, 'average_birth_year': None})
+        if 'gender' in self.tables:
+            summary['gender'] = frequency_frame(self.tables['gender'].series(), 'gender')
+        years = self.tables['birth_year'].series() if 'birth_year' in self.tables else None
+        if years is not None and years.sum() > 0:
+            summary['popular_birth_year'] = int(years.idxmax())
+            summary['popular_birth_year_count'] = int(years.max())
+            summary['average_birth_year'] = (years.index.to_numpy(dtype=np.int64) * years).sum() / years.sum()
+        return summary
+
+
+def aggregate_chunks(chunks):
+    """Aggregate a stream of dataframes of trips one chunk at a time.
+    INPUT:
+        chunks - iterable of dataframes of trips
+    OUTPUTS:
+        aggregate (TripAggregate) - the merged aggregate of every chunk
+    """
+    aggregate = None
+    for chunk in chunks:
+        part = TripAggregate.from_frame(chunk)
+        aggregate = part if aggregate is None else aggregate.merge(part)
+    if aggregate is None:
+        raise ValueError('No trips to aggregate')
+    return aggregate
+
+
+class TripCube:
+    """Trip statistics per (month, weekday, hour) cell of a city.
+
+    Like TripAggregate, but the frequency tables are BucketTables, kept per
+    (month, weekday) bucket, so any month/day filter is answered by adding
+    up the rows of its buckets without touching the trips again.
+    """
+
+    def __init__(self, cells, tables):
+        self.cells = cells
+        self.tables = tables
+
+    @classmethod
+    def from_frame(cls, df):
+        """Build the cube of a dataframe of trips (with the compact schema of datastore)."""
+        cell = cell_ids(df)
+        return cls(_cell_frame(df, cell), _count_tables(df, cell // NUM_HOURS))
+
+    def merge(self, other):
+        """Get the cube of the trips of both cubes."""
+        return TripCube.combine([self, other])
+
+    @classmethod
+    def combine(cls, cubes):
+        """Get the cube of the trips of several cubes."""
+        cells = _combine_cells([cube.cells for cube in cubes])
+        tables = {}
+        for name in TABLE_COLUMNS:
+            parts = [cube.tables[name] for cube in cubes if name in cube.tables]
+            if parts:
+                tables[name] = BucketTable.combine(parts) if len(parts) > 1 else parts[0]
+        return cls(cells, tables)
+
+    def select(self, month=None, weekday=None):
+        """Get the cells matching a month (1 to 12) and a weekday (Monday is 0).
+        None selects every month (weekday).
+        """
+        cell_month, cell_weekday, _ = cell_dimensions(self.cells.index)
+        selected = np.ones(len(self.cells), dtype=bool)
+        if month is not None:
+            selected &= cell_month == month
+        if weekday is not None:
+            selected &= cell_weekday == weekday
+        return self.cells.index[selected]
+
+    def aggregate(self, month=None, weekday=None):
+        """Roll up the cells matching a month/day filter into a TripAggregate."""
+        tables = {name: table.rollup(month, weekday) for name, table in self.tables.items()}
+        return TripAggregate(self.cells.loc[self.select(month, weekday)], tables)
+
+    @profiling.timed('cube_rollup')
+    def rollup(self, month=None, weekday=None, num_stations=10):
+        """Answer a month/day filter from the cube alone.
+        INPUTS:
+            month (int) - month number (1 to 12), or None for every month
+            weekday (int) - day of the week (Monday is 0), or None for every day
+            num_stations (int) - number of most popular trips to keep
+        OUTPUTS:
+            summary (dict) - the same statistics as bikeshare.compute_summary
+        """
+        return self.aggregate(month, weekday).summary(num_stations)
+
+    def save(self, prefix):
+        """Write the cube to files starting with prefix."""
+        datastore.write_atomically(prefix + '.cells.feather', self.cells.reset_index().to_feather)
+        for name, table in self.tables.items():
+            def write(tmp_path, table=table):
+                with open(tmp_path, 'wb') as f:
+                    np.savez(f, **table.arrays())
+            datastore.write_atomically('{}.{}.npz'.format(prefix, name), write)
+
+    @classmethod
+    def load(cls, prefix):
+        """Read a cube written by save."""
+        cells = pd.read_feather(prefix + '.cells.feather').set_index('cell')
+        tables = {}
+        for name in TABLE_COLUMNS:
+            path = '{}.{}.npz'.format(prefix, name)
+            if os.path.exists(path):
+                with np.load(path) as arrays:
+                    tables[name] = BucketTable.from_arrays(arrays)
+        return cls(cells, tables)
+
+
+# Cubes read or built by this process: absolute csv path -> (sha1 of the data, cube)
+_LOADED = {}
+
+
+def cube_paths(csv_path):
+    """Get the file prefix and the description file of the cube of a city csv file."""
+    data_path = datastore.cache_paths(csv_path)[0]
+    prefix = os.path.splitext(data_path)[0] + '.cube'
+    return prefix, prefix + '.json'
+
+
+def _cube_meta(meta):
+    # What the saved cube was built from
+    return {'sha1': meta['sha1'], 'schema_version': datastore.SCHEMA_VERSION, 'cube_version': CUBE_VERSION}
+
+
+def _cube_fresh(cube_meta, meta):
+    # The saved cube, with its deltas, holds the trips of the cached data
+    return (meta is not None and cube_meta is not None
+            and all(cube_meta.get(key) == value for key, value in _cube_meta(meta).items()))
+
+
+def has_fresh_cube(csv_path):
+    """Whether the cube of a city csv file is up to date, so load_cube reads it instead of building it."""
+    meta = datastore.read_fresh_meta(csv_path)
+    loaded = _LOADED.get(os.path.abspath(csv_path))
+    if meta is not None and loaded is not None and loaded[0] == meta['sha1']:
+        return True
+    return _cube_fresh(datastore.read_json(cube_paths(csv_path)[1]), meta)
+
+
+def _remove_deltas(prefix, names):
+    # Delta cubes are files named <name>.<part>
+    folder = os.path.dirname(prefix)
+    for file_name in os.listdir(folder):
+        if any(file_name.startswith(name + '.') for name in names):
+            try:
+                os.remove(os.path.join(folder, file_name))
+            except OSError:
+                pass
+
+
+def _remember(csv_path, meta, cube):
+    # Keep the cube in memory for the next load_cube of the same data
+    _LOADED[os.path.abspath(csv_path)] = (meta['sha1'], cube)
+
+
+def save_cube(csv_path, cube):
+    """Store the cube of a city csv file next to its columnar cache, if there is one."""
+    meta = datastore.read_fresh_meta(csv_path)
+    if meta is None:
+        # No columnar cache (pyarrow missing), keep the cube in memory only
+        return
+    prefix, meta_path = cube_paths(csv_path)
+    previous = datastore.read_json(meta_path) or {}
+    cube.save(prefix)
+    datastore.write_json(meta_path, dict(_cube_meta(meta), deltas=[]))
+    _remove_deltas(prefix, previous.get('deltas', []))
+    _remember(csv_path, meta, cube)
+
+
+def build_cube(csv_path):
+    """Build the cube of a city csv file from its columnar cache and store it alongside.
+    INPUT:
+        csv_path (str) - path of the city csv file
+    OUTPUTS:
+        cube (TripCube) - the cube of all the trips of the city
+    """
+    cube = TripCube.from_frame(datastore.load_frame(csv_path))
+    save_cube(csv_path, cube)
+    return cube
+
+
+@profiling.timed()
+def load_cube(csv_path):
+    """Load the cube of a city csv file, rebuilding it when the data changed.
+
+    The cube is read from disk once, with the delta cubes of the appended
+    trips, later calls get the same cube from memory as long as the sha1 of
+    the data is unchanged.
+    INPUT:
+        csv_path (str) - path of the city csv file
+    OUTPUTS:
+        cube (TripCube) - the cube of all the trips of the city
+    """
+    prefix, meta_path = cube_paths(csv_path)
+    meta = datastore.read_fresh_meta(csv_path)
+    if meta is None:
+        return build_cube(csv_path)
+    loaded = _LOADED.get(os.path.abspath(csv_path))
+    if loaded is not None and loaded[0] == meta['sha1']:
+        return loaded[1]
+    cube_meta = datastore.read_json(meta_path)
+    if not _cube_fresh(cube_meta, meta):
+        return build_cube(csv_path)
+    folder = os.path.dirname(prefix)
+    cubes = [TripCube.load(prefix)] + [TripCube.load(os.path.join(folder, name)) for name in cube_meta['deltas']]
+    cube = TripCube.combine(cubes) if len(cubes) > 1 else cubes[0]
+    _remember(csv_path, meta, cube)
+    return cube
+
+
+def append_trips(csv_path, rows):
+    """Add new trips to a city, folding them into its cube instead of rebuilding it.
+
+    The cube of the new trips is stored as a delta next to the cube, only
+    the buckets and cells the new trips fall in are merged. When the cache
+    merges its segments the merged cube is stored and the deltas removed.
+    INPUT:
+        csv_path (str) - path of the city csv file
+        rows - dataframe of new trips, see datastore.validate_trips
+    OUTPUTS:
+        new - the new trips in the compact schema
+    """
+    prefix, meta_path = cube_paths(csv_path)
+    cube_meta = datastore.read_json(meta_path)
+    cube = None
+    if _cube_fresh(cube_meta, datastore.read_fresh_meta(csv_path)):
+        cube = load_cube(csv_path)
+
+    new, meta = datastore.append_trips(csv_path, rows)
+    if cube is None or meta is None or not len(new):
+        return new
+    delta = TripCube.from_frame(new)
+    cube = cube.merge(delta)
+    if not meta['segments']:
+        save_cube(csv_path, cube)
+        return new
+    name = '{}.delta-{}'.format(os.path.basename(prefix), meta['sha1'][:16])
+    delta.save(os.path.join(os.path.dirname(prefix), name))
+    datastore.write_json(meta_path, dict(_cube_meta(meta), deltas=cube_meta['deltas'] + [name]))
+    _remember(csv_path, meta, cube)
+    return new
+
+
+def _partition_cube(partition):
+    # Runs in a worker process: the cube of one month of one city
+    csv_path, month = partition
+    df = datastore.load_frame(csv_path, month)
+    return csv_path, TripCube.from_frame(df) if len(df) else None
+
+
+def build_cubes_parallel(csv_paths, max_workers=None):
+    """Build the cubes of several city csv files, one month per task, in parallel.
+
+    Each worker process reads one (city, month) partition from the columnar
+    cache and returns its partial cube. The months of a city have disjoint
+    cells and buckets, so its partial cubes are combined in one step and
+    stored like build_cube does. With a single worker every city is built
+    whole by build_cube.
+    INPUTS:
+        csv_paths (list) - paths of the city csv files
+        max_workers (int) - number of worker processes, the number of cores by default
+    OUTPUTS:
+        cubes (dict) - csv path -> TripCube of all the trips of the city
+    """
+    # Build the columnar caches first so the workers do not all parse the csv files
+    for csv_path in csv_paths:
+        datastore.ensure_cache(csv_path)
+
+    if (max_workers or os.cpu_count() or 1) == 1:
+        # Nothing runs in parallel, splitting the cities into months would only add work
+        return {csv_path: build_cube(csv_path) for csv_path in csv_paths}
+
+    partitions = [(csv_path, month) for csv_path in csv_paths
+                  for month in range(1, datastore.NUM_MONTHS + 1)]
+    parts = {}
+    # Forked workers would inherit the locks held by the threads of the caller
+    # (streamlit server, Prefetcher, caches) and could deadlock on them, so they
+    # start from a fresh interpreter (forkserver, spawn where there is no fork)
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=multiprocessing.get_context(start_method)) as executor:
+        # map keeps the partition order, so the combined cubes are deterministic
+        for csv_path, cube in executor.map(_partition_cube, partitions):
+            if cube is not None:
+                parts.setdefault(csv_path, []).append(cube)
+
+    cubes = {csv_path: TripCube.combine(city_parts) for csv_path, city_parts in parts.items()}
+    for csv_path, cube in cubes.items():
+        save_cube(csv_path, cube)
+    return cubes
+
+
+if __name__ == "__main__":
+    # Offline build step: refresh the cubes of every city
+    import argparse
+    from bikeshare import CITY_DATA
+
+    parser = argparse.ArgumentParser(description="Build the aggregate cubes of the city datasets.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of worker processes (the number of cores by default)")
+    args = parser.parse_args()
+
+    print('Building the cubes of {} ...'.format(', '.join(city.title() for city in CITY_DATA)))
+    build_cubes_parallel(list(CITY_DATA.values()), args.workers)
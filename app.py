@@ -1,9 +1,18 @@
+import uuid
+import threading
 import pandas as pd
 import streamlit as st
-import plotly.express as px
 
 
-from bikeshare import load_data, time_stats, station_stats, trip_duration_stats, user_stats
+import cache
+import aggregates
+import profiling
+import figures
+from cache import DATASETS
+from bikeshare import CITY_DATA
+
+# Every span recorded after this one belongs to this rerun of the page
+rerun_seq = profiling.REGISTRY.next_seq()
 
 st.set_page_config(layout="wide")
 pd.set_option('display.max_rows', None)
@@ -17,7 +26,7 @@ st.title("Exploration of US Bikeshare Data in Popular Cities")
 
 
 with st.sidebar:
-    city = st.selectbox("Select The City To Explore: ", ('Chicago', 'New York City', "Washington"))
+    city = st.selectbox("Select The City To Explore: ", tuple(name.title() for name in CITY_DATA))
     city = city.lower()
     st.write('')
     st.write('')
@@ -26,16 +35,23 @@ with st.sidebar:
     st.write('')
     day = st.selectbox("Which Day are you interested in?:  ", ('all', 'sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday'))
     st.write('')
+    # Charts are only built when they are shown
+    show_charts = st.checkbox("Show the charts", value=True)
+    show_timings = st.checkbox("Show the timings of this page (debug)")
+    compare = st.checkbox("Compare all the cities")
     st.write('')
-    df = load_data(city, month, day)
+    # The filtered trips are a view of the city data shared by every session
+    df = DATASETS.view(city, month, day)
+    # Answer every statistic of the page from the precomputed cube of the city,
+    # memoized per selection and invalidated when the city file changes
+    summary = cache.summary(city, month, day, num_stations=10)
     st.write('')
     st.subheader("Important Descriptive Statistics of the Bikeshare")
-    st.metric("Total times of Bikeshare Usage:", value= df.shape[0])
-    popular_month, pop_day_of_week, pop_hour, count_of_most_popular_month = time_stats(df)
-    st.metric(label="Most Popular Month:", value=popular_month)
-    st.metric(label="Number of Times of Usage in Most Popular Month:", value=count_of_most_popular_month)
-    st.metric(label="Most Popular Day of the Week:", value=pop_day_of_week)
-    st.metric(label="Most Popular Hour of Usage:", value=pop_hour)
+    st.metric("Total times of Bikeshare Usage:", value= summary['trip_count'])
+    st.metric(label="Most Popular Month:", value=summary['popular_month'])
+    st.metric(label="Number of Times of Usage in Most Popular Month:", value=summary['popular_month_count'])
+    st.metric(label="Most Popular Day of the Week:", value=summary['popular_day_of_week'])
+    st.metric(label="Most Popular Hour of Usage:", value=summary['popular_hour'])
 
     st.write('')
     url = "https://github.com/Ernestoffor/"
@@ -48,110 +64,153 @@ with st.sidebar:
     
 
 
+if compare:
+    # Every city under the same filter, from the cached summaries of the cities
+    st.subheader("Comparison of the Cities for month: {}, day: {}".format(month, day))
+    comparison = cache.compare_cities(month, day, num_stations=10)
+    st.table(comparison.applymap(
+        lambda value: '' if pd.isna(value) else '{:,.2f}'.format(value) if isinstance(value, float) else str(value)))
+    if show_charts:
+        durations = ['average_time'] + [aggregates.percentile_name(quantile) for quantile in aggregates.QUANTILES]
+        st.plotly_chart(figures.city_comparison(comparison, durations, "Trip Durations in Seconds by City").figure)
+
+
 # Divide the Page into Two Columns
 col1, col2 = st.columns(2)
 
 
 with col1:
-    popular_start_station, popular_end_station, pop_trip, df_pop_trip = station_stats(df, num_stations=10)
-    with st.expander("View the Bar and Pie Charts of the 10 Most Popular Trips"):
-        fig = px.bar(df_pop_trip, y="frequency", x="trips", color="trips", title="10 Most popular trips in {}".format(city))
-        st.plotly_chart(fig)
-        fig1 = px.pie(df_pop_trip, values='frequency', names='trips', title = "The 10 most Popular Trips")
-        st.plotly_chart(fig1)
+    df_pop_trip = summary['popular_trips']
+    if show_charts and st.checkbox("View the Bar and Pie Charts of the 10 Most Popular Trips"):
+        st.plotly_chart(figures.popular_trips_bar(df_pop_trip, city).figure)
+        st.plotly_chart(figures.popular_trips_pie(df_pop_trip).figure)
 
     st.subheader("View the Stations Crucial Information")
     st.write("Most Popular Start Station: ")
-    st.write(popular_start_station) 
+    st.write(summary['popular_start_station'])
     st.write('')
     st.write("Most Popular End Station: ")
-    st.write(popular_end_station)
+    st.write(summary['popular_end_station'])
     st.write('')
     st.write("Most Popular Trip: " )
-    st.write(pop_trip)
+    st.write(summary['popular_trip'])
 
-    total_travel_time, average_time, longest_trip_duration, fastest_trip_duration, longest_trip, fastest_trip = trip_duration_stats(df)
+    average_time = summary['average_time']
+    longest_trip_duration = summary['longest_trip_duration']
+    fastest_trip_duration = summary['fastest_trip_duration']
     st.write('')
     st.markdown("**Trip Time Information**")
-    st.metric("The Total Time for All Trips in Seconds: ", total_travel_time)
+    st.metric("The Total Time for All Trips in Seconds: ", summary['total_travel_time'])
     st.metric("The Longest Trip Duration in Seconds: ", value= longest_trip_duration, delta=longest_trip_duration - average_time)
     st.metric("The Average Trip Duration in Seconds: ", value= average_time)
     st.metric("The Shortest Trip Duration in Seconds: ", value = fastest_trip_duration, delta=fastest_trip_duration - average_time)
     st.write('')
     st.write("The Fastest Trip: ")
-    st.write(fastest_trip)
+    st.write(summary['fastest_trip'])
     st.write('')
     st.write("The Longest Trip: ")
-    st.write(longest_trip)
+    st.write(summary['longest_trip'])
+    st.write('')
+    # Unlike the mean and the longest trip, the percentiles are not moved by a few outliers
+    for name, value in summary['duration_percentiles'].items():
+        st.metric("The {} Trip Duration in Seconds: ".format(name.upper()), value=round(value, 2))
+    if st.checkbox("View the duration distribution"):
+        durations = cache.duration_stats(city, month, day, num_trips=10)
+        if show_charts and durations['histogram'] is not None:
+            st.plotly_chart(figures.duration_histogram(durations['histogram']).figure)
+        st.write("The 10 Longest Trips: ")
+        st.table(durations['longest_trips'])
+        st.write("The 10 Shortest Trips: ")
+        st.table(durations['shortest_trips'])
     
     st.write('')
     st.write('')
     with st.expander('Hide/Show the raw data'):
         length = df.shape[0]
-        st.session_state.start  = st.radio("Select the index to start with", (0, 0))
-        st.session_state.interval = st.radio("Choose intervals", (5,5))
-        con = st.selectbox("Do you want to load first 5 rows of the raw data?",
-        ('No', 'Yes'))
-        if con.lower() =='yes':
-            st.write("The Raw Dataset from {} Bikeshare: ".format(city.title()))
-            st.table(df.iloc[st.session_state.start: st.session_state.start + st.session_state.interval, :])
-
-        
-        #st.dataframe(df.iloc[st.session_state.start: st.session_state.start + st.session_state.interval, :])
-        #while st.session_state.start < length:
-        for i in range(0, length):
-            st.session_state.key = i
-            
-            choice = st.selectbox("Do you want to load the next 5 rows of the raw data?",
-        ('No', 'Yes'), key = st.session_state.key)
-            
-            if choice.lower() =='yes':
-                st.session_state.start += st.session_state.interval
-                st.write("The Next Five Rows of Raw Dataset from {} Bikeshare: ".format(city.title()))
-                st.table(df.iloc[st.session_state.start: st.session_state.start + st.session_state.interval, :])
-            else:
-                break
-               
-       
+        # Only the requested page of rows is taken from the shared city data
+        page_size = st.selectbox("Rows per page", (5, 10, 25, 50, 100))
+        sort_by = st.selectbox("Sort by", ['None'] + list(df.columns))
+        ascending = st.radio("Order", ('Ascending', 'Descending')) == 'Ascending'
+        num_pages = max(1, -(-length // page_size))
+        page_number = st.number_input("Page (of {})".format(num_pages), min_value=1, max_value=num_pages, value=1, step=1)
+        start = (int(page_number) - 1) * page_size
+        st.write("The Raw Dataset from {} Bikeshare, rows {} to {} of {}: ".format(
+            city.title(), min(start + 1, length), min(start + page_size, length), length))
+        st.table(cache.page(city, month, day, start, page_size,
+                            None if sort_by == 'None' else sort_by, ascending))
+
+
 with col2:
    st.header("Users Information")
-   df_user_type, earliest_usage, most_recent_usage, fig = user_stats(df)
-   
-   st.plotly_chart(fig)
+   if show_charts:
+       st.plotly_chart(figures.user_types_bar(summary['user_types']).figure)
    st.write('')
 
    
    st.write('Earliest Usage of the Bikeshare: ')
-   st.write(earliest_usage)
+   st.write(summary['earliest_usage'])
    st.write('')
    st.write('The Most Recent Usage of the Bikeshare')
-   st.write(most_recent_usage)
+   st.write(summary['most_recent_usage'])
    st.write('')
    
 
-   if city.lower() != 'washington':
-       # Convert the Gender series to dataframe
-       gender= df['Gender'].value_counts().to_frame()
-       gender.insert(0, 'gender', gender.index)
-       gender= gender.reset_index().drop('index', axis=1)
-       gender.rename(columns={'Gender': 'frequency'} , inplace=True)
-       gender_count = df['Gender'].value_counts()
+   # Gender, Birth Year and their cross-tab with the user types, for the
+   # columns the city data has
+   demographics = cache.demographics(city, month, day)
+   if demographics['gender'] is not None:
+       gender = demographics['gender']
      
        st.write("The Gender Spread of the Users is as follows: ")
        st.table(gender)
     # Display the user gender Graphically
-       fig1 = px.pie(gender, values='frequency', names='gender', title = "The Bikesare Users By Gender")
-       st.plotly_chart(fig1)
+       if show_charts:
+           st.plotly_chart(figures.gender_pie(gender).figure)
 
-       most_users_by_yob = df[df['Birth Year'] == df['Birth Year'].mode()[0]] # ['Birth Year'][:1]
-       most_users_by_yob = most_users_by_yob.iloc[0]['Birth Year']
-       avg_yob = df['Birth Year'].mean()
-       num_of_most_users_by_yob = df[df['Birth Year'] == df['Birth Year'].mode()[0]].shape[0]
+   if demographics['popular_birth_year'] is not None:
+       most_users_by_yob = demographics['popular_birth_year']
+       avg_yob = demographics['average_birth_year']
+       num_of_most_users_by_yob = demographics['popular_birth_year_count']
        st.metric('The most common users of the bikeshare  are born in: ', most_users_by_yob, delta=most_users_by_yob - avg_yob)
        
        #
        st.write('')
        st.metric("Number Of Users with Modal Year of Birth:", num_of_most_users_by_yob)
-
-
-    
\ No newline at end of file
+       if show_charts:
+           st.plotly_chart(figures.birth_years_bar(demographics['birth_years']).figure)
+
+   crosstab = demographics['crosstab']
+   if crosstab.index.nlevels > 1 and st.checkbox("View the trips by user group"):
+       table = crosstab.unstack(crosstab.index.names[1:])
+       # Without the groups nobody is in
+       st.table(table.loc[:, table.any()])
+
+
+st.subheader("The Bikeshare Usage over Time")
+if show_charts and st.checkbox("View the trips over time"):
+    freq = st.selectbox("Granularity", ('hour', '15min', 'day', 'week'))
+    window = st.number_input("Sum over the last buckets", min_value=1, max_value=1000, value=1, step=1)
+    curves = cache.trips_over_time(city, month, day, freq=freq, window=int(window))
+    user_types = [name for name in curves.columns if name not in ('trips', 'duration_total', 'duration_mean')]
+    st.plotly_chart(figures.trips_over_time(curves, ['trips'] + user_types,
+                                            "Trips per {} in {}".format(freq, city.title())).figure)
+    st.plotly_chart(figures.trips_over_time(curves, ['duration_mean'],
+                                            "Mean trip duration in seconds per {}".format(freq)).figure)
+
+
+if show_timings:
+    # The stages run for this page by this session, cached results take no time
+    spans = profiling.REGISTRY.since(rerun_seq, threading.get_ident())
+    with st.expander("Timings of this page", expanded=True):
+        if spans:
+            timings = pd.DataFrame([span.as_dict() for span in spans])
+            st.table(timings[['name', 'parent', 'duration_s', 'rows', 'memory_delta_bytes']])
+        else:
+            st.write("Every result of this page came from the caches.")
+
+
+# Once the page is shown, warm the other cities and the nearby filters in
+# the background; a new selection of this session drops the older work
+if 'prefetch_owner' not in st.session_state:
+    st.session_state.prefetch_owner = uuid.uuid4().hex
+cache.PREFETCHER.schedule(city, month, day, owner=st.session_state.prefetch_owner)
@@ -0,0 +1,303 @@
+"""Benchmarks of loading, filtering and the statistics on synthetic trip data.
+
+Generate city files of any size with the schema of the real ones and time
+load_data, every month/day filter and the stats functions of bikeshare.py.
+Each measurement runs in a fresh process so its peak memory is its own.
+
+    python benchmark.py run --rows 10000 100000 1000000 --output results.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py check results.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import numpy as np
+import pandas as pd
+
+import datastore
+
+DATA_DIR = '.benchmark'
+# Name under which the synthetic file is loaded through load_data
+CITY = 'synthetic'
+NUM_STATIONS = 600
+FIRST_DAY = pd.Timestamp('2017-01-01')
+NUM_DAYS = 181
+USER_TYPES = ['Subscriber', 'Customer', 'Dependent']
+USER_TYPE_SHARES = [0.8, 0.19, 0.01]
+GENDERS = ['Male', 'Female']
+
+# Filters measured by default, every (month, day) pair with --all-filters
+FILTERS = [('all', 'all'), ('march', 'all'), ('all', 'friday'), ('march', 'friday')]
+# Loading cases, and the stats cases which get the filtered data as input
+LOAD_CASES = ['load_csv', 'load_data']
+STATS_CASES = ['time_stats', 'station_stats', 'trip_duration_stats', 'user_stats',
+               'compute_summary', 'cube_summary', 'stream_summary', 'demographics', 'duration_stats']
+# Cube builds, measured without a filter: build_cubes_parallel has to beat build_cube
+BUILD_CASES = ['build_cube', 'build_cubes_parallel']
+
+
+def generate_trips(path, rows, demographics=True, seed=0, chunksize=1000000):
+    """Write a synthetic city csv file.
+    INPUTS:
+        path (str) - path of the csv file to write
+        rows (int) - number of trips
+        demographics (bool) - add the Gender and Birth Year columns of Chicago
+            and New York City, Washington has none
+        seed (int) - seed of the random generator, the same seed gives the same file
+        chunksize (int) - number of trips generated and written at a time
+    """
+    rng = np.random.default_rng(seed)
+    # A few stations are much busier than the others, as in the real data
+    popularity = 1 / np.arange(1, NUM_STATIONS + 1)
+    popularity /= popularity.sum()
+    stations = np.array(['Station {}'.format(i) for i in range(NUM_STATIONS)], dtype=object)
+
+    tmp_path = path + '.tmp'
+    for first in range(0, rows, chunksize):
+        size = min(chunksize, rows - first)
+        start = FIRST_DAY + pd.to_timedelta(rng.integers(0, NUM_DAYS * 86400, size), unit='s')
+        duration = rng.integers(60, 5000, size)
+        chunk = pd.DataFrame({
+            'Start Time': start.strftime(datastore.TIME_FORMAT),
+            'End Time': (start + pd.to_timedelta(duration, unit='s')).strftime(datastore.TIME_FORMAT),
+            'Trip Duration': duration,
+            'Start Station': stations[rng.choice(NUM_STATIONS, size, p=popularity)],
+            'End Station': stations[rng.choice(NUM_STATIONS, size, p=popularity)],
+            'User Type': np.array(USER_TYPES, dtype=object)[rng.choice(len(USER_TYPES), size, p=USER_TYPE_SHARES)]},
+            index=pd.RangeIndex(first, first + size))
+        if demographics:
+            gender = np.array(GENDERS, dtype=object)[rng.integers(0, len(GENDERS), size)]
+            gender[rng.random(size) < 0.15] = None
+            birth_year = rng.integers(1940, 2002, size).astype(float)
+            birth_year[rng.random(size) < 0.15] = np.nan
+            chunk['Gender'] = gender
+            chunk['Birth Year'] = birth_year
+        # The index is the unnamed first column of the real files
+        chunk.to_csv(tmp_path, mode='w' if first == 0 else 'a', header=first == 0)
+    os.replace(tmp_path, path)
+
+
+def data_path(data_dir, rows, demographics=True):
+    """Get the path of the synthetic file of a size, generating it if needed."""
+    name = 'trips_{}{}.csv'.format(rows, '' if demographics else '_washington')
+    path = os.path.join(data_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        print('Generating {} trips into {} ...'.format(rows, path), file=sys.stderr)
+        generate_trips(path, rows, demographics)
+    return path
+
+
+def _remove_caches(path):
+    folder = datastore.cache_folder(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            if name.startswith(stem + '.'):
+                os.remove(os.path.join(folder, name))
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_case(case, path, month, day, repeat):
+    """Time one case in the current process.
+    OUTPUTS:
+        result (dict) - rows processed, wall times (best and median of the
+            repeats) in seconds and the peak RSS of the process in megabytes
+    """
+    import bikeshare
+
+    bikeshare.CITY_DATA[CITY] = path
+    rows = None
+    if case == 'load_csv':
+        # Parse the csv file and build its cache every time
+        def call():
+            _remove_caches(path)
+            return bikeshare.load_data(CITY, month, day)
+        repeat = 1
+    elif case == 'load_data':
+        datastore.ensure_cache(path)
+        def call():
+            return bikeshare.load_data(CITY, month, day)
+    elif case == 'cube_summary':
+        import aggregates
+        aggregates.load_cube(path)
+        def call():
+            return bikeshare.cube_summary(CITY, month, day)
+    elif case in BUILD_CASES:
+        import aggregates
+        datastore.ensure_cache(path)
+        def call():
+            if case == 'build_cube':
+                return aggregates.build_cube(path)
+            return aggregates.build_cubes_parallel([path])[path]
+    elif case == 'stream_summary':
+        def call():
+            return bikeshare.stream_summary(CITY, month, day)
+        repeat = 1
+    else:
+        df = bikeshare.load_data(CITY, month, day)
+        rows = len(df)
+        function = getattr(bikeshare, case)
+        def call():
+            return function(df)
+
+    walls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = call()
+        walls.append(time.perf_counter() - start)
+    if isinstance(output, pd.DataFrame):
+        rows = len(output)
+    elif isinstance(output, dict):
+        # The summaries count their trips, the other statistics keep the filtered rows
+        rows = output.get('trip_count', rows)
+    elif hasattr(output, 'cells'):
+        # A cube
+        rows = int(output.cells['count'].sum())
+    return {'rows': rows, 'wall_s': min(walls), 'wall_median_s': float(np.median(walls)),
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def _commit():
+    # The commit of the code being measured, wherever the benchmark is run from
+    def git(*args):
+        return subprocess.run(['git'] + list(args), capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    try:
+        commit = git('rev-parse', 'HEAD')
+        dirty = bool(git('status', '--porcelain', '--untracked-files=no'))
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def run_suite(sizes, cases, filters, repeat=3, data_dir=DATA_DIR, demographics=True):
+    """Run every case on every file size and filter, each in its own process.
+    OUTPUTS:
+        report (dict) - the environment (commit, versions) and one result per measurement
+    """
+    commit, dirty = _commit()
+    report = {'commit': commit, 'dirty': dirty, 'python': platform.python_version(),
+              'pandas': pd.__version__, 'numpy': np.__version__, 'platform': platform.platform(),
+              'results': []}
+    for size in sizes:
+        path = data_path(data_dir, size, demographics)
+        for case in cases:
+            for month, day in [('all', 'all')] if case in BUILD_CASES else filters:
+                command = [sys.executable, os.path.abspath(__file__), 'case', case, path, month, day,
+                           '--repeat', str(repeat)]
+                finished = subprocess.run(command, capture_output=True, text=True)
+                result = {'case': case, 'size': size, 'month': month, 'day': day}
+                if finished.returncode:
+                    result['error'] = finished.stderr.strip().splitlines()[-1]
+                else:
+                    result.update(json.loads(finished.stdout.strip().splitlines()[-1]))
+                    result['rows_per_s'] = size / result['wall_s'] if result['wall_s'] else None
+                print('{case:>20} {size:>10} {month:>8} {day:>8} '.format(**result)
+                      + ('{wall_s:10.4f}s {peak_rss_mb:8.1f}MB'.format(**result) if 'error' not in result
+                         else result['error']), file=sys.stderr)
+                report['results'].append(result)
+    return report
+
+
+def _key(result):
+    return result['case'], result['size'], result['month'], result['day']
+
+
+def compare(before, after):
+    """Print the change of the wall time and peak memory of every measurement of two reports."""
+    old = {_key(result): result for result in before['results'] if 'error' not in result}
+    print('{:>20} {:>10} {:>8} {:>8} {:>10} {:>10} {:>8} {:>9}'.format(
+        'case', 'size', 'month', 'day', 'before s', 'after s', 'speedup', 'rss MB'))
+    for result in after['results']:
+        previous = old.get(_key(result))
+        if previous is None or 'error' in result:
+            continue
+        speedup = previous['wall_s'] / result['wall_s'] if result['wall_s'] else float('inf')
+        print('{:>20} {:>10} {:>8} {:>8} {:10.4f} {:10.4f} {:7.2f}x {:+9.1f}'.format(
+            *_key(result), previous['wall_s'], result['wall_s'], speedup,
+            result['peak_rss_mb'] - previous['peak_rss_mb']))
+
+
+def check_builds(report):
+    """Print whether build_cubes_parallel beat build_cube at every size of a report.
+    OUTPUTS:
+        faster (bool) - False when the parallel build was slower at any size
+    """
+    walls = {(result['case'], result['size']): result['wall_s'] for result in report['results']
+             if result['case'] in BUILD_CASES and 'error' not in result}
+    faster = True
+    for size in sorted({size for _, size in walls}):
+        if ('build_cube', size) not in walls or ('build_cubes_parallel', size) not in walls:
+            continue
+        sequential, parallel = walls['build_cube', size], walls['build_cubes_parallel', size]
+        print('{:>10} build_cube {:.4f}s build_cubes_parallel {:.4f}s {}'.format(
+            size, sequential, parallel, 'ok' if parallel < sequential else 'SLOWER'))
+        faster &= parallel < sequential
+    return faster
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark loading, filtering and the statistics on synthetic trips.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="run the benchmarks and write the results as json")
+    run.add_argument('--rows', type=int, nargs='+', default=[10**4, 10**5, 10**6],
+                     help="sizes of the synthetic files, from 10000 up to 100000000 trips")
+    run.add_argument('--cases', nargs='+', default=LOAD_CASES + STATS_CASES + BUILD_CASES,
+                     choices=LOAD_CASES + STATS_CASES + BUILD_CASES)
+    run.add_argument('--all-filters', action='store_true', help="measure every (month, day) filter")
+    run.add_argument('--repeat', type=int, default=3, help="timed calls per measurement, the best one is kept")
+    run.add_argument('--washington', action='store_true', help="generate files without Gender and Birth Year")
+    run.add_argument('--data-dir', default=DATA_DIR, help="folder of the synthetic files")
+    run.add_argument('--output', help="json file of the results, printed when missing")
+
+    case = commands.add_parser('case', help="time one case (used by run)")
+    case.add_argument('case', choices=LOAD_CASES + STATS_CASES + BUILD_CASES)
+    case.add_argument('path')
+    case.add_argument('month')
+    case.add_argument('day')
+    case.add_argument('--repeat', type=int, default=3)
+
+    comparison = commands.add_parser('compare', help="compare two results files")
+    comparison.add_argument('before')
+    comparison.add_argument('after')
+
+    check = commands.add_parser('check', help="fail unless the parallel cube build beats build_cube")
+    check.add_argument('results')
+
+    args = parser.parse_args(argv)
+    if args.command == 'case':
+        print(json.dumps(run_case(args.case, args.path, args.month, args.day, args.repeat)))
+    elif args.command == 'compare':
+        with open(args.before) as before, open(args.after) as after:
+            compare(json.load(before), json.load(after))
+    elif args.command == 'check':
+        with open(args.results) as f:
+            if not check_builds(json.load(f)):
+                sys.exit(1)
+    else:
+        from bikeshare import MONTHS, DAYS
+        filters = FILTERS
+        if args.all_filters:
+            filters = [(month, day) for month in ['all'] + MONTHS for day in ['all'] + DAYS]
+        report = run_suite(args.rows, args.cases, filters, args.repeat, args.data_dir, not args.washington)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=1, default=str)
+        else:
+            print(json.dumps(report, indent=1, default=str))
+
+
+if __name__ == "__main__":
+    main()
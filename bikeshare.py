@@ -1,15 +1,31 @@
-import time
 import pandas as pd
 import numpy as np
-from datetime import timedelta
-import plotly.express as px
-import plotly.graph_objects as go
 
-CITY_DATA = { 'chicago': 'chicago.csv',
-              'new york city': 'new_york_city.csv',
-              'washington': 'washington.csv' }
+import datastore
+import aggregates
+import routes
+import figures
+import storage
+import profiling
 
+# City name -> data file, from cities.json (see storage.load_cities)
+CITY_DATA = storage.load_cities()
 
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june']
+# Ordered as pandas numbers them, Monday is 0
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def filter_numbers(month, day):
+    """Turn month and day names (or "all") into the month number (1 to 12)
+    and the day of the week (Monday is 0), None for "all"."""
+    # use the index of the months and days lists to get the corresponding int
+    month = None if month == 'all' else MONTHS.index(month) + 1
+    day = None if day == 'all' else DAYS.index(day.lower())
+    return month, day
+
+
+@profiling.timed()
 def load_data(city, month, day):
     """
     Loads data for the specified city and filters by month and day if applicable.
@@ -21,38 +37,266 @@ def load_data(city, month, day):
     Returns:
         df - Pandas DataFrame containing city data filtered by month and day
     """
-     # load data file into a dataframe
-    df = pd.read_csv(CITY_DATA[city])
+    month, day = filter_numbers(month, day)
 
-    # convert the Start Time column to datetime
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
-    
-    # convert the End Time column to datetime
-    df['End Time'] = pd.to_datetime(df['End Time'])
-    # extract month and day of week from Start Time to create new columns
-    df['month'] = df['Start Time'].dt.month
-    df['day_of_week'] = df['Start Time'].dt.day_name()
+    # read only the rows of the matching (month, day of week) buckets of the
+    # city data, the store of the city file does the filtering
+    df = open_store(city).load(month, day)
 
-    # filter by month if applicable
-    if month != 'all':
-        # use the index of the months list to get the corresponding int
-        months = ['january', 'february', 'march', 'april', 'may', 'june']
-        month = months.index(month) + 1
+    return df
 
-        # filter by month to create the new dataframe
-        df = df[df['month'] == month]
 
-   
-    # filter by day of week if applicable
-    if day != 'all':
-        # filter by day of week to create the new dataframe
-        df = df[df['day_of_week'] == day.title()]
-    # Drop this column called 'Unnamed: 0'
-    df = df.drop('Unnamed: 0', axis=1)
+def sort_order(df, sort_by, ascending=True):
+    """Get the positions of the rows of a dataframe sorted by a column.
 
+    The sort is stable and puts missing values last, categorical columns
+    sort in the order of their categories (names for the stations).
+    """
+    column = df[sort_by].reset_index(drop=True)
+    return column.sort_values(ascending=ascending, kind='mergesort', na_position='last').index.to_numpy()
 
-    return df
 
+def paginate(df, offset=0, page_size=5, order=None):
+    """Get one page of rows of a dataframe.
+
+    Without an order the page is a slice (a view) of the dataframe, with one
+    (see sort_order) only page_size rows are taken, so a page costs the same
+    wherever it starts.
+    INPUTS:
+        df - the filtered dataframe
+        offset (int) - position of the first row of the page
+        page_size (int) - number of rows of the page
+        order (array) - positions of the rows in the display order, or None
+    OUTPUTS:
+        page - dataframe of at most page_size rows
+    """
+    offset = min(max(offset, 0), len(df))
+    if order is None:
+        return df.iloc[offset:offset + page_size]
+    return df.take(order[offset:offset + page_size])
+
+
+def open_store(city):
+    """Get the store (csv, parquet or SQLite, see storage.py) of the data file of a city."""
+    return storage.open_store(CITY_DATA[city])
+
+
+def _csv_path(city):
+    """Get the csv file of a city, for the operations only done on csv files."""
+    path = CITY_DATA[city]
+    if not isinstance(storage.open_store(path), storage.CsvStore):
+        raise ValueError('{} is stored in {}, this needs a csv file'.format(city.title(), path))
+    return path
+
+
+def append_trips(city, rows):
+    """
+    Adds a batch of new trips to the data of a city.
+
+    The trips are appended to the city csv file and merged into its cache and
+    its cube, the statistics of the next load_data or cube_summary include
+    them without reading the whole file again.
+
+    Args:
+        (str) city - name of the city the trips belong to
+        rows - Pandas DataFrame of new trips with the columns of the city csv file
+    Returns:
+        new - the new trips, with the columns added by load_data
+    """
+    return aggregates.append_trips(_csv_path(city), rows)
+
+
+def _count_codes(codes, size):
+    """Count how often each integer code (0 to size - 1) occurs, ignoring missing (-1) codes."""
+    codes = np.asarray(codes)
+    return np.bincount(codes[codes >= 0], minlength=size)
+
+
+def _trip_name(stations, start, end):
+    """Get the 'start---end' name of a trip from its station codes."""
+    if start < 0 or end < 0:
+        return np.nan
+    return aggregates.trip_name(stations[start], stations[end])
+
+
+def _value_counts_frame(series, label):
+    """Get the counts of a categorical column as a dataframe, most frequent first."""
+    return aggregates.frequency_frame(series.value_counts(), label)
+
+
+def _time_summary(df):
+    """Most frequent times of travel, see time_stats."""
+    # Get the most common month from the counts of the month numbers
+    month_counts = _count_codes(df['month'], datastore.NUM_MONTHS + 1)
+    pop_month = month_counts.argmax()
+
+    # day_of_week is stored as codes of the week day names
+    day_counts = _count_codes(df['day_of_week'].cat.codes, datastore.NUM_WEEKDAYS)
+
+    return {'popular_month': pop_month,
+            'popular_month_count': month_counts[pop_month],
+            'popular_day_of_week': df['day_of_week'].cat.categories[day_counts.argmax()],
+            # Get the most common start hour of the day
+            'popular_hour': _count_codes(datastore.time_fields(df['Start Time'])[2], 24).argmax()}
+
+
+def _station_summary(start, end, stations, num_stations):
+    """Most popular stations and trips from the station codes, see station_stats."""
+    num_codes = len(stations)
+
+    # Count the trips of every (start, end) pair in a sparse origin-destination matrix
+    pop_trips = routes.ODMatrix.from_codes(start, end, stations).top(num_stations)
+
+    return {'popular_start_station': stations[_count_codes(start, num_codes).argmax()],
+            'popular_end_station': stations[_count_codes(end, num_codes).argmax()],
+            'popular_trip': aggregates.trip_name(pop_trips[0].start, pop_trips[0].end),
+            'popular_trip_stations': (pop_trips[0].start, pop_trips[0].end),
+            # Define a dataframe for trip statistics
+            'popular_trips': pd.DataFrame({
+                'trips': [aggregates.trip_name(route.start, route.end) for route in pop_trips],
+                'frequency': [route.count for route in pop_trips]})}
+
+
+def _percentiles(durations, quantiles=aggregates.QUANTILES):
+    """Exact durations at quantiles, the duration of rank q * (count - 1) like DurationSketch."""
+    durations = durations[~np.isnan(durations)]
+    ranks = np.floor(np.asarray(quantiles) * (len(durations) - 1)).astype(np.int64)
+    # Partial sort: only the ranks asked for end up in place
+    values = np.partition(durations, ranks)[ranks]
+    return {aggregates.percentile_name(quantile): value for quantile, value in zip(quantiles, values)}
+
+
+def _duration_summary(df, start, end, stations):
+    """Total, average, percentiles, longest and shortest trips, see trip_duration_stats."""
+    # Positions of the longest and shortest trips
+    durations = df['Trip Duration'].to_numpy()
+    longest, fastest = np.nanargmax(durations), np.nanargmin(durations)
+
+    return {'total_travel_time': df['Trip Duration'].sum(),
+            'average_time': df['Trip Duration'].mean(),
+            'duration_percentiles': _percentiles(durations.astype(np.float64)),
+            'longest_trip_duration': durations[longest],
+            'fastest_trip_duration': durations[fastest],
+            # Look up their stations from the station codes
+            'longest_trip': _trip_name(stations, start[longest], end[longest]),
+            'fastest_trip': _trip_name(stations, start[fastest], end[fastest])}
+
+
+def _user_summary(df):
+    """User type counts and the first and last usage, see user_stats."""
+    return {'user_types': _value_counts_frame(df['User Type'], 'user_types'),
+            'earliest_usage': df['Start Time'].min(),
+            'most_recent_usage': df['End Time'].max()}
+
+
+# Lower bounds of the age groups of demographics, in years
+AGE_BOUNDS = (0, 18, 25, 35, 45, 55, 65)
+# Label of the trips missing the value of a dimension of the cross-tab
+UNKNOWN = 'Unknown'
+
+
+def _birth_year_counts(df):
+    """Trips per year of birth from the oldest to the youngest year, None without any year."""
+    if 'Birth Year' not in df.columns:
+        return None
+    years = df['Birth Year'].dropna().to_numpy(dtype=np.int64)
+    if len(years) == 0:
+        return None
+    # Count the years relative to the oldest one
+    oldest = years.min()
+    year_counts = np.bincount(years - oldest)
+    return pd.Series(year_counts, index=pd.RangeIndex(oldest, oldest + len(year_counts), name='birth_year'),
+                     name='frequency')
+
+
+def _demographic_summary(df):
+    """Gender counts and the most common year of birth.
+
+    The values are None for the columns the data does not have (Washington
+    has no Gender and Birth Year columns).
+    """
+    summary = {'gender': None, 'popular_birth_year': None,
+               'popular_birth_year_count': None, 'average_birth_year': None}
+    if 'Gender' in df.columns:
+        summary['gender'] = _value_counts_frame(df['Gender'], 'gender')
+    year_counts = _birth_year_counts(df)
+    if year_counts is not None:
+        summary['popular_birth_year'] = int(year_counts.idxmax())
+        summary['popular_birth_year_count'] = int(year_counts.max())
+        summary['average_birth_year'] = ((year_counts.index.to_numpy() * year_counts.to_numpy()).sum()
+                                         / year_counts.sum())
+    return summary
+
+
+def age_labels(age_bounds=AGE_BOUNDS):
+    """Get the names of the age groups starting at age_bounds, e.g. '18-24' and '65+'."""
+    labels = ['{}-{}'.format(low, high - 1) for low, high in zip(age_bounds[:-1], age_bounds[1:])]
+    return labels + ['{}+'.format(age_bounds[-1])]
+
+
+def _age_codes(df, age_bounds):
+    # Age group of every trip from the age of the rider in the year of the trip,
+    # -1 for the trips without a year of birth or with an age under age_bounds[0]
+    trip_years = df['Start Time'].to_numpy(dtype='datetime64[Y]').astype(np.int64) + 1970
+    birth_years = df['Birth Year'].astype('float64').to_numpy()
+    ages = trip_years - np.nan_to_num(birth_years, nan=np.inf)
+    codes = np.searchsorted(np.asarray(age_bounds, dtype=np.float64), ages, side='right') - 1
+    return np.where(np.isnan(birth_years), -1, codes)
+
+
+def _dimension(codes, labels):
+    # Codes shifted so the missing values (-1) get the last label, Unknown
+    codes = np.asarray(codes, dtype=np.int64)
+    return np.where(codes < 0, len(labels), codes), list(labels) + [UNKNOWN]
+
+
+@profiling.timed()
+def demographics(df, age_bounds=AGE_BOUNDS):
+    """Get the Birth Year histogram and the age group x user type x gender cross-tab.
+
+    The dimensions come from the columns of the data: without Birth Year
+    there is no age group and no histogram, without Gender no gender. The
+    cross-tab is counted in a single bincount over the combined codes of
+    the dimensions.
+    INPUT:
+        df - filtered dataframe
+        age_bounds (tuple) - lower bounds of the age groups, in years
+    OUTPUTS:
+        demographics (dict) - the gender, popular_birth_year,
+            popular_birth_year_count and average_birth_year of compute_summary,
+            with:
+            birth_years - Series of the trips per year of birth, from the
+                oldest to the youngest year (None without Birth Year)
+            crosstab - Series of the trips indexed by (age_group, user_type,
+                gender), every combination present and the missing values
+                labelled Unknown; e.g. crosstab.unstack('gender') gives a
+                table per age group and user type
+    """
+    summary = _demographic_summary(df)
+    summary['birth_years'] = _birth_year_counts(df)
+
+    dimensions = []
+    if 'Birth Year' in df.columns:
+        dimensions.append(('age_group',) + _dimension(_age_codes(df, age_bounds), age_labels(age_bounds)))
+    for column, name in (('User Type', 'user_type'), ('Gender', 'gender')):
+        if column in df.columns:
+            codes, labels = datastore.category_codes(df[column])
+            dimensions.append((name,) + _dimension(codes, labels))
+
+    # Mixed radix: the code of a trip is its codes in every dimension combined
+    combined = np.zeros(len(df), dtype=np.int64)
+    for _, codes, labels in dimensions:
+        combined = combined * len(labels) + codes
+    sizes = [len(labels) for _, _, labels in dimensions]
+    counts = np.bincount(combined, minlength=int(np.prod(sizes)))
+    summary['crosstab'] = pd.Series(
+        counts, name='trips',
+        index=pd.MultiIndex.from_product([labels for _, _, labels in dimensions],
+                                         names=[name for name, _, _ in dimensions]))
+    return summary
+
+
+@profiling.timed()
 def trip_duration_stats(df):
     """Displays statistics on the total and average trip duration.
     INPUT:
@@ -65,20 +309,69 @@ def trip_duration_stats(df):
         longest_trip (str)  - longest trip
         fastest_trip (str)  - shortest trip
     """
-
-
-    # display total travel time
-    total_travel_time = df['Trip Duration'].sum()
-    average_time =  df['Trip Duration'].mean()
-    longest_trip_duration =  df['Trip Duration'].max()
-    fastest_trip_duration =  df['Trip Duration'].min()
-    df['trip'] = df['Start Station']  +  '---' + df['End Station']
-    longest_trip = df[df['Trip Duration'] == longest_trip_duration].iloc[0]['trip']
-    fastest_trip = df[df['Trip Duration'] == fastest_trip_duration].iloc[0]['trip']
-
-    return total_travel_time, average_time, longest_trip_duration, fastest_trip_duration, longest_trip, fastest_trip    
-
-
+    summary = _duration_summary(df, *datastore.station_codes(df))
+
+    return (summary['total_travel_time'], summary['average_time'], summary['longest_trip_duration'],
+            summary['fastest_trip_duration'], summary['longest_trip'], summary['fastest_trip'])
+
+
+def _extreme_trips(df, durations, stations, start, end, num_trips, longest):
+    """The num_trips longest (shortest) trips, longest (shortest) first."""
+    # Missing durations go last either way
+    keys = np.where(np.isnan(durations), -np.inf, durations if longest else -durations)
+    num_trips = min(num_trips, int((~np.isnan(durations)).sum()))
+    if num_trips == 0:
+        rows = np.zeros(0, dtype=np.int64)
+    else:
+        # Only the num_trips largest keys are found, then sorted among themselves
+        rows = np.argpartition(keys, len(keys) - num_trips)[len(keys) - num_trips:]
+        rows = rows[np.argsort(-keys[rows], kind='stable')]
+    return pd.DataFrame({'trip': [_trip_name(stations, start[row], end[row]) for row in rows],
+                         'duration': durations[rows],
+                         'start_time': df['Start Time'].to_numpy()[rows]})
+
+
+@profiling.timed()
+def duration_stats(df, num_trips=10, bins=20, quantiles=aggregates.QUANTILES):
+    """Get the distribution of the trip durations.
+
+    The histogram spans the shortest trip to the last percentile asked for,
+    the longer trips are counted in one last open bin so a few outliers do
+    not squeeze every other trip into the first bin.
+    INPUT:
+        df - filtered dataframe
+        num_trips (int) - number of longest and shortest trips to keep
+        bins (int) - number of bins of the histogram, the open bin aside
+        quantiles (tuple) - quantiles (0 to 1) of the percentiles
+    OUTPUTS:
+        duration_stats (dict) - with:
+            percentiles - dict of the exact durations at the quantiles, e.g. {'p50': ...}
+            histogram - dataframe with the low, high and frequency columns
+            longest_trips, shortest_trips - dataframes with the trip, duration
+                and start_time columns, longest (shortest) first
+    """
+    durations = df['Trip Duration'].to_numpy(dtype=np.float64)
+    start, end, stations = datastore.station_codes(df)
+    stats = {'longest_trips': _extreme_trips(df, durations, stations, start, end, num_trips, True),
+             'shortest_trips': _extreme_trips(df, durations, stations, start, end, num_trips, False),
+             'percentiles': None, 'histogram': None}
+    if np.isnan(durations).all():
+        return stats
+
+    stats['percentiles'] = _percentiles(durations, quantiles)
+    known = durations[~np.isnan(durations)]
+    low, high = known.min(), max(stats['percentiles'].values())
+    if high <= low:
+        # Every trip takes the same time
+        high = low + 1
+    edges = np.linspace(low, high, bins + 1)
+    counts = np.histogram(known[known <= high], bins=edges)[0]
+    stats['histogram'] = pd.DataFrame({'low': edges, 'high': np.append(edges[1:], known.max()),
+                                       'frequency': np.append(counts, (known > high).sum())})
+    return stats
+
+
+@profiling.timed()
 def user_stats(df):
     """Displays statistics on bikeshare users.
     INPUT:
@@ -87,49 +380,18 @@ def user_stats(df):
         df_user_type      - dataframe of user types counts
         earliest_usage    - oldest datetime at which the Bikeshare was used
         most_recent_usage - latest datetime at which the Bikeshare was used
-        fig               -  an instance of the user types bar chart
-    """
-
-    
-
-    # Display counts of user types
-    # Get the counts of user types as a dataframe
-    df_user_type= df['User Type'].value_counts().to_frame()
-    df_user_type.insert(0, 'user_types', df_user_type.index)
-    df_user_type= df_user_type.reset_index().drop('index', axis=1)
-    df_user_type.rename(columns={'User Type': 'frequency'} , inplace=True)
-    
-    
-    
-    # Display the user type Graphically
-    
-    fig =px.bar(df_user_type, y="frequency", x="user_types", color="user_types", title="The Bikeshare for the User Types ")
-    
-    # Display earliest, most recent, and most common year of birth
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
-    df['End Time'] = pd.to_datetime(df['End Time'])
-
-    earliest_usage = df[df['Start Time'] ==df['Start Time'].min()]
-    # Get the specific time
-    
-    earliest_usage = earliest_usage.iloc[0]['Start Time']
-    print('=='*50)
-    #mode = df['Birth Year'].mode()
-    #  Dataframe containing most recent month
-    
-    most_recent_usage = df[df['End Time'] ==df['End Time'].max()]
-    # Get the cell
-    most_recent_usage = most_recent_usage.iloc[0]['End Time']
-
-    return df_user_type, earliest_usage, most_recent_usage, fig
-    
-    
-    
-    
-    
+        fig               -  the user types bar chart, built when first used (figures.LazyFigure)
+    """
+    summary = _user_summary(df)
+    df_user_type = summary['user_types']
+
+    # Display the user type Graphically, plotly only runs if the chart is used
+    fig = figures.user_types_bar(df_user_type)
 
+    return df_user_type, summary['earliest_usage'], summary['most_recent_usage'], fig
 
 
+@profiling.timed()
 def time_stats(df):
     """Getting statistics on the most frequent times of travel.
     '\nCalculating The Most Frequent Times of Travel in {}...\n'
@@ -143,23 +405,13 @@ def time_stats(df):
         most popular month
 
     """
+    summary = _time_summary(df)
 
-
-    # Get the most common month
-
-    df = df.copy()
-    #  most popular month 
-    pop_month = df['month'].mode()[0]
-    count_of_most_popular_month = df[df['month'] == pop_month].shape[0]
-
-    pop_day_of_week = df['day_of_week'].mode()[0]
-    
-    # Get the most common start hour of the day
-    pop_hour = df['Start Time'].dt.hour.mode()[0]
-    
-    return pop_month, pop_day_of_week, pop_hour, count_of_most_popular_month
+    return (summary['popular_month'], summary['popular_day_of_week'], summary['popular_hour'],
+            summary['popular_month_count'])
 
 
+@profiling.timed()
 def station_stats(df, num_stations= 10):
     """Get statistics on the most popular stations and trip.
     INPUTS:
@@ -171,31 +423,181 @@ def station_stats(df, num_stations= 10):
         pop_trip (str)  -      Most popular trip
         df_pop_trip     -  dataframe of num_stations most popular stations
     """
-    # Get the most popular station
-    popular_start_station = df['Start Station'].mode()[0]
-    # display most commonly used end station
-    popular_end_station = df['End Station'].mode()[0]
+    # Work on the codes of the city station table instead of the names
+    summary = _station_summary(*datastore.station_codes(df), num_stations)
+
+    return (summary['popular_start_station'], summary['popular_end_station'], summary['popular_trip'],
+            summary['popular_trips'])
+
+
+@profiling.timed()
+def compute_summary(df, num_stations=10):
+    """Get every statistic shown by the web app and the terminal report at once.
+
+    The station codes are extracted once and each column is counted once
+    with bincount/unique, instead of every stats function scanning the
+    dataframe again.
+    INPUTS:
+        df - the filtered dataframe
+        num_stations (int) - number of most popular trips to keep
+    OUTPUTS:
+        summary (dict) - trip_count and the values of time_stats, station_stats,
+            trip_duration_stats and user_stats (without the figure), plus the
+            gender counts and the most common year of birth when available
+    """
+    start, end, stations = datastore.station_codes(df)
 
-    # Get most frequent combination of start station and end station trip
-    # Broadcast the separator between start and end stations
-    df['trip'] = df['Start Station'] + "---" + df['End Station']
-    pop_trip = df['trip'].mode()[0]
-    # Separate trip by start and end stations
-    #[start, end] = df['trip'].mode().str.split('---')[0]
-    # Define a dataframe for trip statistics
-    df_pop_trip = df['trip'].value_counts().to_frame()
-    df_pop_trip.insert(0, 'trips', df_pop_trip.index)
-    df_pop_trip = df_pop_trip.reset_index()
-    df_pop_trip = df_pop_trip.rename(columns = {'trip': 'frequency'})
-    
-    #df_pop_trip['trip'] = df_pop_trip.drop('index', axis = 1)
-    df_pop_trip = df_pop_trip.iloc[: num_stations, :]
-    #df_pop_trip.drop('index', axis=1, inplace=True)
+    summary = {'trip_count': len(df)}
+    summary.update(_time_summary(df))
+    summary.update(_station_summary(start, end, stations, num_stations))
+    summary.update(_duration_summary(df, start, end, stations))
+    summary.update(_user_summary(df))
+    summary.update(_demographic_summary(df))
+    return summary
 
-    return popular_start_station, popular_end_station, pop_trip, df_pop_trip
-   
 
+@profiling.timed()
+def cube_summary(city, month, day, num_stations=10):
+    """Get the statistics of compute_summary from the store of a city.
 
-    
+    For a csv file, the (month, weekday, hour) cells of the precomputed cube
+    are rolled up without touching the trips themselves, the cube is only
+    rebuilt when the city data changes. A SQLite database answers with SQL
+    queries, a parquet file reads the row groups of the filter only.
+    INPUTS:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        num_stations (int) - number of most popular trips to keep
+    OUTPUTS:
+        summary (dict) - see compute_summary
+    """
+    month, day = filter_numbers(month, day)
+    return open_store(city).summary(month, day, num_stations)
 
 
+@profiling.timed()
+def stream_summary(city, month, day, num_stations=10, chunksize=100000):
+    """Get the statistics of compute_summary reading the city file in chunks.
+
+    Only one chunk of trips is in memory at a time, each one is folded into
+    mergeable counts, sums and extremes, so files larger than the memory
+    give the same results as load_data followed by compute_summary.
+    INPUTS:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        num_stations (int) - number of most popular trips to keep
+        chunksize (int) - number of csv rows read at a time
+    OUTPUTS:
+        summary (dict) - see compute_summary
+    """
+    month, day = filter_numbers(month, day)
+    chunks = datastore.iter_chunks(_csv_path(city), chunksize, month, day)
+    return aggregates.aggregate_chunks(chunks).summary(num_stations)
+
+
+def parallel_summaries(cities=None, months=None, days=None, num_stations=10, workers=None):
+    """Get the statistics of many filters at once, building the cubes in parallel.
+
+    The (city, month) partitions are aggregated in a pool of worker processes
+    and merged into one cube per city, every filter is then a cheap rollup.
+    INPUTS:
+        cities (list) - names of the cities, every city of CITY_DATA by default
+        months (list) - month names or "all", every option by default
+        days (list) - day names or "all", every option by default
+        num_stations (int) - number of most popular trips to keep
+        workers (int) - number of worker processes, the number of cores by default
+    OUTPUTS:
+        summaries (dict) - (city, month, day) -> summary (see compute_summary),
+            None for filters without any trips
+    """
+    cities = list(CITY_DATA) if cities is None else cities
+    months = ['all'] + MONTHS if months is None else months
+    days = ['all'] + DAYS if days is None else days
+    csv_cities = [city for city in cities if isinstance(open_store(city), storage.CsvStore)]
+    cubes = aggregates.build_cubes_parallel([CITY_DATA[city] for city in csv_cities], workers)
+
+    summaries = {}
+    for city in cities:
+        # No cube when the city has no trips at all
+        cube = cubes.get(CITY_DATA[city])
+        for month in months:
+            for day in days:
+                summary = None
+                if city not in csv_cities:
+                    # The other stores answer each filter themselves
+                    try:
+                        summary = open_store(city).summary(*filter_numbers(month, day), num_stations)
+                    except ValueError:
+                        pass
+                elif cube is not None and len(cube.select(*filter_numbers(month, day))):
+                    summary = cube.rollup(*filter_numbers(month, day), num_stations)
+                summaries[(city, month, day)] = summary
+    return summaries
+
+
+# Values of a summary shown side by side by compare_cities, in this order
+COMPARISON_METRICS = ['trip_count', 'popular_month', 'popular_day_of_week', 'popular_hour',
+                      'popular_start_station', 'popular_end_station', 'popular_trip',
+                      'total_travel_time', 'average_time', 'longest_trip_duration', 'fastest_trip_duration',
+                      'earliest_usage', 'most_recent_usage', 'popular_birth_year', 'average_birth_year']
+
+
+def _comparison_column(summary):
+    """The values of one city in the comparison table, None for a filter without trips."""
+    if summary is None:
+        return {'trip_count': 0}
+    column = {metric: summary[metric] for metric in COMPARISON_METRICS}
+    column.update(summary['duration_percentiles'])
+    # Share of the trips of every user type and gender, comparable across cities of any size
+    for key, label in (('user_types', 'user_types'), ('gender', 'gender')):
+        if summary[key] is not None:
+            for value, frequency in zip(summary[key][label], summary[key]['frequency']):
+                column['{} share: {}'.format(label, value)] = frequency / summary['trip_count']
+    return column
+
+
+@profiling.timed()
+def compare_cities(month, day, cities=None, num_stations=10, workers=None, summarise=None):
+    """Get the statistics of several cities side by side, under the same month/day filter.
+
+    The summary of every city comes from its aggregates (see cube_summary),
+    never from its trips. The cubes of the csv cities missing or out of date
+    are first built together in worker processes (build_cubes_parallel),
+    then every city is a rollup of its cube kept in memory, which takes a
+    few milliseconds, so the rollups run one after the other.
+    INPUTS:
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        cities (list) - names of the cities, every city of CITY_DATA by default
+        num_stations (int) - number of most popular trips to keep
+        workers (int) - number of worker processes building the missing
+            cubes, the number of cores by default
+        summarise - function of (city, month, day, num_stations) returning the
+            summary of a city, cube_summary by default (cache.summary caches them)
+    OUTPUTS:
+        comparison - dataframe with one row per metric (the COMPARISON_METRICS,
+            the duration percentiles and the user type and gender shares) and
+            one column per city, missing values where a city has no such value
+    """
+    cities = list(CITY_DATA) if cities is None else cities
+    summarise = cube_summary if summarise is None else summarise
+
+    def summarise_city(city):
+        try:
+            return summarise(city, month, day, num_stations=num_stations)
+        except ValueError:
+            # No trips in the filter
+            return None
+
+    cold = [CITY_DATA[city] for city in cities if isinstance(open_store(city), storage.CsvStore)
+            and not aggregates.has_fresh_cube(CITY_DATA[city])]
+    if cold:
+        aggregates.build_cubes_parallel(cold, workers)
+    summaries = [summarise_city(city) for city in cities]
+
+    columns = {city.title(): _comparison_column(summary) for city, summary in zip(cities, summaries)}
+    # Rows in the order they first appear, the shares after the common metrics
+    rows = list(dict.fromkeys(metric for column in columns.values() for metric in column))
+    return pd.DataFrame(columns, index=pd.Index(rows, name='metric'), dtype=object)
@@ -1,15 +1,16 @@
-import time
+import os
+import json
+import argparse
 import pandas as pd
 import numpy as np
-from datetime import timedelta
-import plotly.express as px
-import plotly.graph_objects as go
 
-pd.set_option("display.max_rows", None, "display.max_columns", None)
+from bikeshare import CITY_DATA, MONTHS, DAYS, load_data, compute_summary, stream_summary, demographics
+from bikeshare import open_store, filter_numbers
+import datastore
+import profiling
+import figures
 
-CITY_DATA = { 'chicago': 'chicago.csv',
-              'new york city': 'new_york_city.csv',
-              'washington': 'washington.csv' }
+pd.set_option("display.max_rows", None, "display.max_columns", None)
 
 def get_filters():
     """
@@ -24,7 +25,7 @@ def get_filters():
     # get user input for city (chicago, new york city, washington). HINT: Use a while loop to handle invalid inputs
     city = input("Enter the city to filter:     ")
     if city.lower() not in CITY_DATA:
-        print("Oops!!! City must be one of ['Chicago', 'New York City', 'Washington'].\n")
+        print("Oops!!! City must be one of {}.\n".format([name.title() for name in CITY_DATA]))
         city = input("Enter the city to filter again:     ")
     
     #while city.lower() in CITY_DATA:
@@ -41,225 +42,285 @@ def get_filters():
     return city, month, day
 
 
-def load_data(city, month, day):
-    """
-    Loads data for the specified city and filters by month and day if applicable.
-
-    Args:
-        (str) city - name of the city to analyze
-        (str) month - name of the month to filter by, or "all" to apply no month filter
-        (str) day - name of the day of week to filter by, or "all" to apply no day filter
-    Returns:
-        df - Pandas DataFrame containing city data filtered by month and day
-    """
-     # load data file into a dataframe
-    df = pd.read_csv(CITY_DATA[city])
-
-    # convert the Start Time column to datetime
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
-    
-    # convert the End Time column to datetime
-    df['End Time'] = pd.to_datetime(df['End Time'])
-    # extract month and day of week from Start Time to create new columns
-    df['month'] = df['Start Time'].dt.month
-    df['day_of_week'] = df['Start Time'].dt.day_name()
-
-    # filter by month if applicable
-    if month != 'all':
-        # use the index of the months list to get the corresponding int
-        months = ['january', 'february', 'march', 'april', 'may', 'june']
-        month = months.index(month) + 1
-
-        # filter by month to create the new dataframe
-        df = df[df['month'] == month]
-
-   
-    # filter by day of week if applicable
-    if day != 'all':
-        # filter by day of week to create the new dataframe
-        df = df[df['day_of_week'] == day.title()]
-    # Drop this column called 'Unnamed: 0'
-    df = df.drop('Unnamed: 0', axis=1)
-
-
-    return df
-
-
-def time_stats(df):
+def time_stats(summary):
     """Displays statistics on the most frequent times of travel."""
 
     print('\nCalculating The Most Frequent Times of Travel ...\n')
-    start_time = time.time()
 
     # display the most common month
-
-    df = df.copy()
-    pop_mo = df['month'].mode()[0]
-    num_of_times_popular_month = df[df['month'] == pop_mo].value_counts().sum()
+    pop_mo = summary['popular_month']
+    num_of_times_popular_month = summary['popular_month_count']
     
     print("The most popular month is {}".format(pop_mo))
     
     print('='*90)
     print("The bikeshare was used {} times in the month of {}".format(num_of_times_popular_month, pop_mo))
     # display the most common day of week
-    pop_day_of_week = df['day_of_week'].mode()[0]
+    pop_day_of_week = summary['popular_day_of_week']
     print("The most popular day of the week is {}".format(pop_day_of_week))
     print('='*90)
     # display the most common start hour
-    pop_hour = df['Start Time'].dt.hour.mode()[0]
+    pop_hour = summary['popular_hour']
 
     print("The most popular start hour is {}".format(pop_hour))
-
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('='*90)
 
 
-def station_stats(df):
+def station_stats(summary):
     """Displays statistics on the most popular stations and trip."""
 
     print('\nCalculating The Most Popular Stations and Trip ...\n')
-    start_time = time.time()
 
     # display most commonly used start station
 
-    popular_start_station = df['Start Station'].mode()[0]
+    popular_start_station = summary['popular_start_station']
     print('='*50)
     print("The most popular start station in the city for US Bikeshare is {}".format( popular_start_station))
     # display most commonly used end station
-    popular_end_station = df['End Station'].mode()[0]
+    popular_end_station = summary['popular_end_station']
     print('='*50)
     print("The most popular end station in the city is \n {}".format( popular_end_station))
 
 
     # display most frequent combination of start station and end station trip
-    # Broadcast the separator between 
-    df['trip'] = df['Start Station'] + "---" + df['End Station']
-    pop_trip = df['trip'].mode()
-    
     # Get the start and end of the most popular trip
-
-    [start, end] = df['trip'].mode().str.split('---')[0]
+    start, end = summary['popular_trip_stations']
+    count = summary['popular_trips']['frequency'].iloc[0]
     print('='*90)
-    print('The most popular trip is {}'.format(pop_trip))
+    print('The most popular trip is {} ({} trips)'.format(summary['popular_trip'], count))
     print('='*90)
     print('The most popular trip is one that starts at\n {} station and ends at {} station'.format(start, end))
     print('='*90)
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
-    print('='*90)
-
-
-    
-
-
 
-
-def trip_duration_stats(df):
+def trip_duration_stats(summary):
     """Displays statistics on the total and average trip duration.
         INPUT:
-            df - the filtered dataframe
+            summary - the statistics of the filtered data, see bikeshare.compute_summary
     """
-    start_time = time.time()
     print('\nCalculating Trip Duration in ...\n')
     
 
     # display total travel time
     print('=='*50)
     
-    total_travel_time = df['Trip Duration'].sum()
+    total_travel_time = summary['total_travel_time']
     print("The total time for the usage of the Bikeshare in the city is  \n {} {}".format(total_travel_time, 'seconds'))
     # display mean travel time
     print('=='*50)
-    average_time = round(df['Trip Duration'].mean(), 2)
-    #average_time_in_seconds = df['trip_duration'].mean().total_seconds()
+    average_time = round(summary['average_time'], 2)
     print("The average usage of the Bikeshare in the city is \n {}".format(average_time))
     print('=='*50)
     print("The average usage of the Bikeshare is \n {} seconds".format(average_time))
     print('=='*50)
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    # Exact from the trips, within 1% from the streamed aggregates
+    percentiles = ', '.join('{} {:.2f}'.format(name, value) for name, value in summary['duration_percentiles'].items())
+    print("The trip durations in seconds by percentile are \n {}".format(percentiles))
     print('=='*50)
 
-def user_stats(df, city):
+def user_stats(summary, charts=True):
     """Displays statistics on bikeshare users.
         INPUT:
-            df - filtered dataframe
-            city - The city to explore Bikeshare usage
+            summary - the statistics of the filtered data, see bikeshare.compute_summary
+            charts (bool) - whether to show the pie charts, they are not even built otherwise
     """
 
     print('\nCalculating User Stats...\n')
-    start_time = time.time()
 
     # Display counts of user types
-    # Get the counts of user types as a dataframe
-    df_user_type= df['User Type'].value_counts().to_frame()
-    df_user_type.insert(0, 'users_type', df_user_type.index)
-    df_user_type= df_user_type.reset_index().drop('index', axis=1)
-    df_user_type.rename(columns={'User Type': 'frequency'} , inplace=True)
+    df_user_type = summary['user_types']
     print("The Bikeshare User Types are shown below:\n {}".format(df_user_type))
     
     print('=='*50)
     
     # Display the user type Graphically
-    fig = px.pie(df_user_type, values='frequency', names='users_type', title = "The Bikesare User Types")
-    fig.show()
+    if charts:
+        figures.user_types_pie(df_user_type).show()
     
     
     
     print('=='*50)
 
     # Display earliest, most recent, and most common year of birth
-    earliest_usage = df[df['Start Time'] ==df['Start Time'].min()]
-    # Get the specific time
-    
-    earliest_usage = earliest_usage.iloc[0]['Start Time']
+    earliest_usage = summary['earliest_usage']
+    most_recent_usage = summary['most_recent_usage']
     print('=='*50)
-    #mode = df['Birth Year'].mode()
-    #  Dataframe containing most recent month
-    
-    most_recent_usage = df[df['End Time'] ==df['End Time'].max()]
-    # Get the cell
-    most_recent_usage = most_recent_usage.iloc[0]['End Time']
     print('The earliest usage of the bike was on \n {}'.format(earliest_usage))
 
     print('The most recent usage of the bike was on \n {}'.format(most_recent_usage))
 
     print('=='*50)
 
-    if city.lower() != "washington":
-        gender= df['Gender'].value_counts().to_frame()
-        gender.insert(0, 'Sex', gender.index)
-        gender= gender.reset_index().drop('index', axis=1)
-        gender.rename(columns={'Gender': 'frequency'} , inplace=True)
+
+def demographic_stats(summary, charts=True):
+    """Displays the gender and year of birth statistics, for the columns the city data has.
+        INPUT:
+            summary - the statistics of the filtered data, see bikeshare.demographics
+                (or bikeshare.compute_summary, without the cross-tab)
+            charts (bool) - whether to show the pie chart, it is not even built otherwise
+    """
+    if summary['gender'] is not None:
+        gender = summary['gender']
     
         print("The Gender Spread of the Users is as follows:\n {}".format(gender))
     
         # Display the user gender Graphically
-        fig1 = px.pie(gender, values='frequency', names='Sex', title = "The Bikesare Users By Gender")
-        fig1.show()
-    
-        most_users_by_yob = df[df['Birth Year'] == df['Birth Year'].mode()[0]] # ['Birth Year'][:1]
-        most_users_by_yob = most_users_by_yob.iloc[0]['Birth Year']
-        num_of_most_users_by_yob = df[df['Birth Year'] == df['Birth Year'].mode()[0]].shape[0]
+        if charts:
+            figures.gender_pie(gender).show()
+
+    if summary['popular_birth_year'] is not None:
+        most_users_by_yob = summary['popular_birth_year']
+        num_of_most_users_by_yob = summary['popular_birth_year_count']
         print('The most common users of the bikeshare by year of birth are \
     those born in {} with total number of {} times usage'.format(most_users_by_yob, num_of_most_users_by_yob))
 
         print('=='*50)
-        print("\nThis took %s seconds." % (time.time() - start_time))
+
+    crosstab = summary.get('crosstab')
+    if crosstab is not None and crosstab.index.nlevels > 1:
+        table = crosstab.unstack(crosstab.index.names[1:])
+        # Without the groups nobody is in
+        print("The trips by user group are as follows:\n {}".format(table.loc[:, table.any()]))
         print('=='*50)
 
 
 
 
 
-def main():
+def _plain(value):
+    """Turn numpy numbers and timestamps into values json can write."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    raise TypeError('Cannot write {!r} as json'.format(value))
+
+
+def summary_record(city, month, day, summary):
+    """Turn the summary of a filter into one record of plain values.
+
+    The tables of the summary (popular trips, user types, gender) become
+    lists of {value, frequency} rows.
+    """
+    record = {'city': city, 'month': month, 'day': day}
+    for key, value in summary.items():
+        if isinstance(value, pd.DataFrame):
+            value = value.to_dict(orient='records')
+        elif isinstance(value, tuple):
+            value = list(value)
+        elif not isinstance(value, (list, dict)) and pd.isna(value):
+            value = None
+        record[key] = value
+    return record
+
+
+def batch_reports(cities, months, days, num_stations=10):
+    """Compute the statistics of every (city, month, day) filter of a grid.
+
+    Each city is loaded once, every filter is a slice of its buckets. The
+    cities are loaded one at a time outside the DatasetCache of the app, so
+    its memory budget neither limits nor is disturbed by the batch.
+    INPUTS:
+        cities, months, days (list) - the names of the grid, "all" included
+        num_stations (int) - number of most popular trips to keep
+    OUTPUTS:
+        records (list) - one summary_record per filter, only the trip_count
+            for filters without any trips
+    """
+    records = []
+    for city in cities:
+        trips, offsets = open_store(city).load_indexed()
+        for month in months:
+            for day in days:
+                df = datastore.take_buckets(trips, offsets, *filter_numbers(month, day))
+                summary = compute_summary(df, num_stations) if len(df) else {'trip_count': 0}
+                records.append(summary_record(city, month, day, summary))
+    return records
+
+
+def write_reports(records, path):
+    """Write batch records to a .json, .csv or .parquet file, after its extension.
+
+    The csv and parquet files have one row per filter, the tables of the
+    summary are json text there.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        with open(path, 'w') as f:
+            json.dump(records, f, indent=1, default=_plain)
+        return
+    if extension not in ('.csv', '.parquet'):
+        raise ValueError('Unknown report format {!r}, use .json, .csv or .parquet'.format(extension))
+
+    df = pd.DataFrame(records)
+    for column in df.columns:
+        nested = df[column].map(lambda value: isinstance(value, (list, dict)))
+        if nested.any():
+            df[column] = df[column].map(
+                lambda value: json.dumps(value, default=_plain) if isinstance(value, (list, dict)) else value)
+    if extension == '.csv':
+        df.to_csv(path, index=False)
+    else:
+        df.to_parquet(path, index=False)
+
+
+def run_batch(args):
+    """Write the reports of the filter grid given on the command line."""
+    with profiling.span('batch') as span:
+        records = batch_reports(args.cities, args.months, args.days, args.num_stations)
+        span.rows = len(records)
+        write_reports(records, args.output)
+    print("Wrote the statistics of {} filters to {} in {:.2f} seconds.".format(len(records), args.output, span.duration))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Explore US bikeshare data in the terminal.")
+    parser.add_argument('--stream', action='store_true',
+                        help="read the city file in chunks instead of loading it whole "
+                             "(for files larger than the memory)")
+    parser.add_argument('--chunksize', type=int, default=100000,
+                        help="number of csv rows read at a time with --stream")
+    parser.add_argument('--no-charts', action='store_true',
+                        help="print the statistics only, without building and showing the charts")
+    parser.add_argument('--timings', action='store_true',
+                        help="print the time taken by every stage of the computation")
+    batch = parser.add_argument_group("batch mode", "compute every filter of a grid without prompting")
+    batch.add_argument('--batch', action='store_true',
+                       help="write the statistics of every (city, month, day) of the grid and exit")
+    batch.add_argument('--cities', nargs='+', choices=list(CITY_DATA), default=list(CITY_DATA))
+    batch.add_argument('--months', nargs='+', choices=['all'] + MONTHS, default=['all'] + MONTHS)
+    batch.add_argument('--days', nargs='+', choices=['all'] + DAYS, default=['all'] + DAYS)
+    batch.add_argument('--num-stations', type=int, default=10, help="number of most popular trips kept")
+    batch.add_argument('--output', default='reports.json',
+                       help="file of the reports, .json, .csv or .parquet")
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        run_batch(args)
+        return
+
     while True:
         city, month, day = get_filters()
-        df = load_data(city, month, day)
 
-        time_stats(df)
-        station_stats(df)
-        trip_duration_stats(df)
-        user_stats(df, city)
+        with profiling.span('statistics') as span:
+            if args.stream:
+                summary = stream_summary(city, month, day, chunksize=args.chunksize)
+            else:
+                df = load_data(city, month, day)
+                summary = compute_summary(df)
+                summary.update(demographics(df))
+        print("\nComputing the statistics took %s seconds." % span.duration)
+        if args.timings:
+            # The stages of this run, in the order they finished
+            for stage in profiling.REGISTRY.since(span.seq - 1):
+                rows = '' if stage.rows is None else '{} rows'.format(stage.rows)
+                print("  {:<20} {:10.4f}s  {}".format(stage.name, stage.duration, rows))
+
+        time_stats(summary)
+        station_stats(summary)
+        trip_duration_stats(summary)
+        user_stats(summary, charts=not args.no_charts)
+        demographic_stats(summary, charts=not args.no_charts)
 
         restart = input('\nWould you like to restart? Enter yes or no.\n')
         if restart.lower() != 'yes':
@@ -0,0 +1,453 @@
+import os
+import shutil
+import pickle
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
+
+import datastore
+import aggregates
+import bikeshare
+import timeseries
+import routes
+import storage
+from bikeshare import CITY_DATA, MONTHS, DAYS, filter_numbers
+
+# Bump whenever the results of the cached functions change so the pickled ones are not served
+RESULTS_VERSION = 2
+# Memory budget of the shared datasets, in megabytes
+DEFAULT_BUDGET_MB = int(os.environ.get('BIKESHARE_CACHE_MB', 1024))
+
+_Entry = namedtuple('_Entry', ['signature', 'df', 'offsets', 'nbytes'])
+
+
+class DatasetCache:
+    """Process-wide cache of the full city datasets, shared by every session.
+
+    Filtered views are slices of the cached frame of the city, so concurrent
+    users of the same city share one copy. The least recently used cities
+    are evicted when the cached frames take more than max_bytes. A city is
+    reloaded when its data file changes. Safe to use from several threads;
+    a city requested by several threads at once is only loaded once.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_BUDGET_MB * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, city, signature):
+        # Must hold self._lock
+        entry = self._entries.get(city)
+        if entry is not None and entry.signature == signature:
+            self._entries.move_to_end(city)
+            self.hits += 1
+            return entry
+        return None
+
+    def _entry(self, city):
+        store = storage.open_store(CITY_DATA[city])
+        signature = store.signature()
+        with self._lock:
+            entry = self._lookup(city, signature)
+            if entry is not None:
+                return entry
+            loading = self._loading.setdefault(city, threading.Lock())
+
+        with loading:
+            # Another thread may have loaded the city while we waited
+            with self._lock:
+                entry = self._lookup(city, signature)
+                if entry is not None:
+                    return entry
+                self.misses += 1
+
+            df, offsets = store.load_indexed()
+            entry = _Entry(signature, df, offsets, int(df.memory_usage(deep=True).sum()))
+            with self._lock:
+                self._sizes[city] = entry.nbytes
+                self._entries.pop(city, None)
+                self._entries[city] = entry
+                self._evict(keep=city)
+            return entry
+
+    def _evict(self, keep):
+        # Must hold self._lock; never evicts the city just loaded
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            del self._entries[oldest]
+            self.evictions += 1
+        if self.nbytes > self.max_bytes and keep in self._entries:
+            # Larger than the whole budget on its own, hand it out without keeping it
+            del self._entries[keep]
+            self.evictions += 1
+
+    @property
+    def nbytes(self):
+        """Memory taken by the cached frames."""
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def cached(self, city):
+        """Whether the current data of a city is in the cache."""
+        signature = storage.open_store(CITY_DATA[city]).signature()
+        with self._lock:
+            entry = self._entries.get(city)
+            return entry is not None and entry.signature == signature
+
+    def fits(self, city):
+        """Whether a city can be loaded without evicting any other one.
+
+        The size of a city never loaded is taken as the size of its csv
+        file, which is more than its compact frame takes.
+        """
+        with self._lock:
+            size = self._sizes.get(city)
+            if size is None:
+                size = os.path.getsize(CITY_DATA[city])
+            return self.nbytes + size <= self.max_bytes
+
+    def get(self, city):
+        """Get all the trips of a city (do not modify the returned frame)."""
+        return self._entry(city).df
+
+    def view(self, city, month, day):
+        """Get the trips of a city filtered like load_data, as a view of the cached frame.
+        INPUTS:
+            (str) city - name of the city to analyze
+            (str) month - name of the month to filter by, or "all" to apply no month filter
+            (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        OUTPUTS:
+            df - the matching trips (do not modify the returned frame)
+        """
+        entry = self._entry(city)
+        return datastore.take_buckets(entry.df, entry.offsets, *filter_numbers(month, day))
+
+    def stats(self):
+        """Get the hit/miss/eviction counters and the memory in use."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'cities': list(self._entries), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def clear(self):
+        """Drop every cached dataset."""
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by every session of the app: modules are imported once per process
+DATASETS = DatasetCache()
+
+
+class ResultCache:
+    """Cache of the statistics computed for a (city, month, day) filter.
+
+    Results are keyed by the function, the version (content hash) of the
+    city data, the filter and the other parameters, so they are never
+    served once the csv file changed. The most recent max_entries results
+    are kept in memory; with persist they are also pickled in the cache
+    folder of the city and survive restarts of the app. The pickles of a
+    city are kept in one folder per version of its data and of the results
+    (RESULTS_VERSION), the folders of the other versions are removed when
+    the first result of a new version is written.
+    """
+
+    def __init__(self, max_entries=512, persist=False):
+        self.max_entries = max_entries
+        self.persist = persist
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _folder(self, city, version):
+        # <stem of the city file>-<hash of the versions>, the cities of a folder share its cache
+        stem = os.path.splitext(os.path.basename(CITY_DATA[city]))[0]
+        name = '{}-{}'.format(stem, hashlib.sha1(repr((RESULTS_VERSION, version)).encode()).hexdigest()[:16])
+        return os.path.join(datastore.cache_folder(CITY_DATA[city]), 'results', name)
+
+    def _path(self, city, version, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest() + '.pkl'
+        return os.path.join(self._folder(city, version), name)
+
+    def _prune(self, folder):
+        # The results of the other versions of the city can never be served again
+        results, name = os.path.split(folder)
+        stem = name.rsplit('-', 1)[0]
+        for other in os.listdir(results):
+            path = os.path.join(results, other)
+            if other.endswith('.pkl'):
+                # Written before the results had a folder per version
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            elif other != name and os.path.isdir(path) and other.rsplit('-', 1)[0] == stem:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _write(self, path, result):
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(result, f)
+
+        folder = os.path.dirname(path)
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder, exist_ok=True)
+                self._prune(folder)
+            datastore.write_atomically(path, write)
+        except OSError:
+            # The cache folder is not writable (read-only, full disk), the
+            # result is kept in memory only, like datastore.build_cache does
+            pass
+
+    def get_or_compute(self, city, version, key, compute):
+        """Get the result stored under key, calling compute() on a miss.
+
+        key has to hold the version of the city data, which also picks the
+        folder of the pickled result.
+        """
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+
+        stored = self._read(self._path(city, version, key)) if self.persist else None
+        if stored is not None:
+            result = stored[0]
+            with self._lock:
+                self.hits += 1
+        else:
+            result = compute()
+            if self.persist:
+                self._write(self._path(city, version, key), (result,))
+            with self._lock:
+                self.misses += 1
+
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+        return result
+
+    def memoize(self, func):
+        """Decorate a function of (city, month, day, **params) to cache its results."""
+        @functools.wraps(func)
+        def wrapper(city, month, day, **params):
+            version = storage.open_store(CITY_DATA[city]).version()
+            key = (func.__name__, RESULTS_VERSION, version, city, month, day, tuple(sorted(params.items())))
+            return self.get_or_compute(city, version, key, lambda: func(city, month, day, **params))
+        return wrapper
+
+    def stats(self):
+        """Get the hit/miss counters and the number of results in memory."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._results)}
+
+    def clear(self):
+        """Drop the results kept in memory (the pickled ones stay valid)."""
+        with self._lock:
+            self._results.clear()
+
+
+RESULTS = ResultCache(persist=True)
+
+
+@RESULTS.memoize
+def summary(city, month, day, num_stations=10):
+    """Cached bikeshare.cube_summary."""
+    return bikeshare.cube_summary(city, month, day, num_stations)
+
+
+@RESULTS.memoize
+def time_stats(city, month, day):
+    """Cached bikeshare.time_stats of a filter."""
+    return bikeshare.time_stats(DATASETS.view(city, month, day))
+
+
+@RESULTS.memoize
+def station_stats(city, month, day, num_stations=10):
+    """Cached bikeshare.station_stats of a filter."""
+    return bikeshare.station_stats(DATASETS.view(city, month, day), num_stations)
+
+
+@RESULTS.memoize
+def trip_duration_stats(city, month, day):
+    """Cached bikeshare.trip_duration_stats of a filter."""
+    return bikeshare.trip_duration_stats(DATASETS.view(city, month, day))
+
+
+@RESULTS.memoize
+def user_stats(city, month, day):
+    """Cached bikeshare.user_stats of a filter, the figure is built when first used."""
+    return bikeshare.user_stats(DATASETS.view(city, month, day))
+
+
+@RESULTS.memoize
+def duration_stats(city, month, day, num_trips=10):
+    """Cached bikeshare.duration_stats of a filter."""
+    return bikeshare.duration_stats(DATASETS.view(city, month, day), num_trips)
+
+
+@RESULTS.memoize
+def demographics(city, month, day):
+    """Cached bikeshare.demographics of a filter."""
+    return bikeshare.demographics(DATASETS.view(city, month, day))
+
+
+@RESULTS.memoize
+def trips_over_time(city, month, day, freq='hour', window=1):
+    """Cached timeseries.rollup (by user type) of a filter, summed over trailing windows of buckets."""
+    curves = timeseries.rollup(DATASETS.view(city, month, day), freq, by_user_type=True)
+    return curves if window == 1 else timeseries.rolling(curves, window)
+
+
+@RESULTS.memoize
+def od_matrix(city, month, day):
+    """Cached origin-destination matrix (routes.ODMatrix, with durations) of a filter."""
+    return routes.ODMatrix.from_frame(DATASETS.view(city, month, day))
+
+
+def compare_cities(month, day, num_stations=10):
+    """bikeshare.compare_cities from the cached summaries of the cities.
+
+    The rollups of the cities run one after the other, only the builds of the
+    missing cubes run in parallel worker processes.
+    """
+    return bikeshare.compare_cities(month, day, num_stations=num_stations, summarise=summary)
+
+
+def _neighbours(options, value):
+    # The options next to value in a list of names, and "all"
+    if value == 'all':
+        return []
+    position = options.index(value)
+    return [options[i] for i in (position - 1, position + 1) if 0 <= i < len(options)] + ['all']
+
+
+class Prefetcher:
+    """Warm on background threads the data the app is likely to need next.
+
+    After a page of (city, month, day) is shown, the summaries of the
+    neighbouring months and days and of the other cities are computed, and
+    the other cities are loaded into datasets while they fit in its memory
+    budget. A summary whose cube has to be built first loads the whole city
+    for it, so it is only computed when the city fits in that budget too.
+    Work scheduled for an earlier selection of the same owner (a
+    session of the app) is dropped when the selection changes.
+    """
+
+    def __init__(self, datasets, max_workers=2, num_stations=10):
+        self.datasets = datasets
+        self.num_stations = num_stations
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='prefetch')
+        self._generations = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.done = 0
+        self.skipped = 0
+        self.over_budget = 0
+
+    def _tasks(self, city, month, day):
+        # Most likely next first: the other cities as they are, then the nearby filters
+        tasks = []
+        others = [other for other in CITY_DATA if other != city]
+        for other in others:
+            tasks.append((self._summary, other, month, day))
+        for other_month in _neighbours(MONTHS, month):
+            tasks.append((self._summary, city, other_month, day))
+        for other_day in _neighbours(DAYS, day):
+            tasks.append((self._summary, city, month, other_day))
+        for other in others:
+            tasks.append((self._load, other))
+        return tasks
+
+    def _summary(self, city, month, day):
+        path = CITY_DATA[city]
+        if (isinstance(storage.open_store(path), storage.CsvStore) and not aggregates.has_fresh_cube(path)
+                and not self.datasets.fits(city)):
+            # build_cube would load the whole city outside the memory budget
+            with self._lock:
+                self.over_budget += 1
+            return
+        summary(city, month, day, num_stations=self.num_stations)
+
+    def _load(self, city):
+        if not self.datasets.cached(city) and self.datasets.fits(city):
+            self.datasets.get(city)
+
+    def _run(self, owner, generation, task):
+        with self._lock:
+            if self._generations.get(owner) != generation:
+                # The selection changed since this was scheduled
+                self.skipped += 1
+                return
+        function, args = task[0], task[1:]
+        function(*args)
+        with self._lock:
+            self.done += 1
+
+    def schedule(self, city, month, day, owner=None):
+        """Drop the pending work of owner and warm what may follow (city, month, day)."""
+        with self._lock:
+            generation = self._generations.get(owner, 0) + 1
+            self._generations[owner] = generation
+            for future in self._pending.pop(owner, []):
+                if future.cancel():
+                    self.skipped += 1
+            # Forget the owners whose work is all finished (sessions of the
+            # app that went away), none of their tasks can run anymore
+            for other in list(self._pending):
+                self._pending[other] = [future for future in self._pending[other] if not future.done()]
+                if not self._pending[other]:
+                    del self._pending[other], self._generations[other]
+            self._pending[owner] = [self._executor.submit(self._run, owner, generation, task)
+                                    for task in self._tasks(city, month, day)]
+
+    def stats(self):
+        """Get the counts of the finished and dropped tasks, and of the summaries left
+        out for the memory budget."""
+        with self._lock:
+            pending = sum(not future.done() for futures in self._pending.values() for future in futures)
+            return {'done': self.done, 'skipped': self.skipped, 'pending': pending,
+                    'over_budget': self.over_budget}
+
+
+PREFETCHER = Prefetcher(DATASETS)
+
+# Sorted row positions for the raw data pages, kept in memory only
+ORDERS = ResultCache(max_entries=32)
+
+
+@ORDERS.memoize
+def _sort_order(city, month, day, sort_by=None, ascending=True):
+    return bikeshare.sort_order(DATASETS.view(city, month, day), sort_by, ascending)
+
+
+def page(city, month, day, offset=0, page_size=5, sort_by=None, ascending=True):
+    """Get a page of the raw data of a filter, see bikeshare.paginate.
+
+    The filtered data is a view of the shared city data and the sort order
+    of a column is computed once, so every page costs the same to render.
+    """
+    df = DATASETS.view(city, month, day)
+    order = None
+    if sort_by is not None:
+        order = _sort_order(city, month, day, sort_by=sort_by, ascending=ascending)
+    return bikeshare.paginate(df, offset, page_size, order)
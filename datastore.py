@@ -0,0 +1,652 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+
+import profiling
+
+# Directory (next to each city csv) holding the preprocessed columnar copies
+CACHE_DIR = '.cache'
+# Bump whenever the layout of the cached frame changes so old caches are rebuilt
+SCHEMA_VERSION = 4
+# The cached rows are sorted into one bucket per (month, day of week) pair
+NUM_MONTHS = 12
+NUM_WEEKDAYS = 7
+NUM_BUCKETS = NUM_MONTHS * NUM_WEEKDAYS
+# Appended trips go to segment files next to the cache until there are more
+# than this many segments or they hold this share of the cached rows, then
+# everything is merged back into the cache
+MAX_SEGMENTS = 16
+MAX_SEGMENT_SHARE = 0.1
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+STATION_COLUMNS = ['Start Station', 'End Station']
+# Optional columns (Chicago and New York City only) and low-cardinality text columns
+CATEGORY_COLUMNS = ['User Type', 'Gender']
+TIME_COLUMNS = ['Start Time', 'End Time']
+# Layout of the timestamps in the city files, e.g. 2017-01-01 09:07:57
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+NS_PER_HOUR = 3600 * 10**9
+NS_PER_DAY = 24 * NS_PER_HOUR
+NUMERIC_COLUMNS = ['Trip Duration', 'Birth Year']
+
+
+def cache_paths(csv_path):
+    """Get the location of the columnar cache of a city csv file.
+    INPUT:
+        csv_path (str) - path of the city csv file
+    OUTPUTS:
+        data_path (str) - path of the feather file holding the parsed data
+        meta_path (str) - path of the json file describing the cached data
+    """
+    folder, name = os.path.split(os.path.abspath(csv_path))
+    stem = os.path.splitext(name)[0]
+    cache_folder = os.path.join(folder, CACHE_DIR)
+    return (os.path.join(cache_folder, stem + '.feather'),
+            os.path.join(cache_folder, stem + '.json'))
+
+
+def source_signature(csv_path):
+    """Get the cheap signature (size and modification time) of a csv file."""
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def file_digest(csv_path, start=0, stop=None, chunk_size=1 << 20):
+    """Get the sha1 hash of the content of a csv file, or of its bytes start to stop."""
+    digest = hashlib.sha1()
+    with open(csv_path, 'rb') as f:
+        f.seek(start)
+        remaining = float('inf') if stop is None else stop - start
+        while remaining > 0:
+            chunk = f.read(int(min(chunk_size, remaining)))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def chain_digest(version, digest):
+    """Get the version of a file grown by appending bytes with the sha1 digest
+    to a file of the given version."""
+    return hashlib.sha1((version + digest).encode()).hexdigest()
+
+
+def content_version(csv_path, parts):
+    """Hash a csv file again range by range.
+    INPUT:
+        csv_path (str) - path of the city csv file
+        parts (list) - [stop, sha1] of the consecutive byte ranges of the file,
+            one range when the cache was built and one more per append
+    OUTPUTS:
+        version (str) - the sha1 of the first range chained with the others,
+            the sha1 of the file when it has one range
+    """
+    start, version = 0, None
+    for stop, _ in parts:
+        digest = file_digest(csv_path, start, stop)
+        version = digest if version is None else chain_digest(version, digest)
+        start = stop
+    return version
+
+
+def decode_timestamps(values, errors='raise'):
+    """Parse timestamps of the city files into datetime64 values.
+
+    Every value is first parsed with the known TIME_FORMAT, without any
+    format inference; only the values that do not match it go through the
+    slower, inferring pd.to_datetime.
+    INPUT:
+        values - Pandas Series of timestamp strings (or already datetimes)
+        errors (str) - passed to pd.to_datetime for the other values
+    OUTPUTS:
+        times - datetime64[ns] Pandas Series
+        fallback (int) - number of values parsed by pd.to_datetime
+    """
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values, 0
+    times = pd.to_datetime(values, format=TIME_FORMAT, errors='coerce')
+    fallback = (times.isna() & values.notna()).to_numpy()
+    if fallback.any():
+        times[fallback] = pd.to_datetime(values[fallback], errors=errors)
+    return times, int(fallback.sum())
+
+
+def time_fields(times):
+    """Get the month (1 to 12), weekday (Monday is 0) and hour of datetime64
+    values with epoch arithmetic."""
+    times = np.asarray(times, dtype='datetime64[ns]')
+    if np.isnat(times).any():
+        raise ValueError('Missing timestamps')
+    ns = times.view(np.int64)
+    month = times.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    # 1970-01-01 was a Thursday
+    weekday = (np.floor_divide(ns, NS_PER_DAY) + 3) % 7
+    hour = np.floor_divide(ns, NS_PER_HOUR) % 24
+    return month.astype(np.int8), weekday.astype(np.int8), hour.astype(np.int8)
+
+
+def parse_trips(df):
+    """Convert the raw columns of trips read from a city csv file.
+
+    The number of timestamps not in TIME_FORMAT is kept in
+    df.attrs['time_fallbacks'].
+    """
+    # convert the Start Time and End Time columns to datetime
+    fallbacks = 0
+    with profiling.span('parse_timestamps', rows=len(df)):
+        for column in TIME_COLUMNS:
+            df[column], fallback = decode_timestamps(df[column])
+            fallbacks += fallback
+    # Drop this column called 'Unnamed: 0'
+    if 'Unnamed: 0' in df.columns:
+        df = df.drop('Unnamed: 0', axis=1)
+    df.attrs['time_fallbacks'] = fallbacks
+    return df
+
+
+def compact_types(df):
+    """Store the text columns of the trips as small integer codes.
+
+    Start and End Station share one sorted station table per city so their
+    category codes can be compared and combined directly.
+    """
+    stations = pd.Index(pd.concat([df[column] for column in STATION_COLUMNS]).dropna().unique())
+    stations = stations.sort_values()
+    for column in STATION_COLUMNS:
+        df[column] = pd.Categorical(df[column], categories=stations)
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    if 'Birth Year' in df.columns:
+        df['Birth Year'] = df['Birth Year'].round().astype('Int16')
+    return df
+
+
+def category_codes(series):
+    """Get the values of a text or categorical column as integer codes, -1 if missing.
+    OUTPUTS:
+        codes (array) - code of the value of every row
+        labels (Index) - the values the codes refer to, sorted
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy(), series.cat.categories
+    return pd.factorize(series, sort=True)
+
+
+def station_codes(df):
+    """Get the start and end stations of the trips as codes of one station table.
+    INPUT:
+        df - dataframe of trips
+    OUTPUTS:
+        start (array) - code of the start station of every trip, -1 if missing
+        end (array) - code of the end station of every trip, -1 if missing
+        stations (Index) - the station names the codes refer to
+    """
+    start, end = (df[column] for column in STATION_COLUMNS)
+    if (isinstance(start.dtype, pd.CategoricalDtype) and isinstance(end.dtype, pd.CategoricalDtype)
+            and start.cat.categories.equals(end.cat.categories)):
+        return start.cat.codes.to_numpy(), end.cat.codes.to_numpy(), start.cat.categories
+    # Text columns, encode both against the stations found in either of them
+    codes, stations = pd.factorize(pd.concat([start, end], ignore_index=True), sort=True)
+    return codes[:len(df)], codes[len(df):], stations
+
+
+def add_time_columns(df):
+    """Extract month and day of week from Start Time to create new columns."""
+    month, weekday, _ = time_fields(df['Start Time'])
+    df['month'] = month
+    df['day_of_week'] = pd.Categorical.from_codes(weekday, categories=WEEKDAY_NAMES, ordered=True)
+    return df
+
+
+def prepare_trips(df):
+    """Turn raw trips from a city csv file into the schema of the cache:
+    parsed timestamps, month and day_of_week columns and compact types."""
+    return compact_types(add_time_columns(parse_trips(df)))
+
+
+def iter_chunks(csv_path, chunksize=100000, month=None, weekday=None):
+    """Read a city csv file in chunks of bounded size, without any cache.
+
+    Every chunk has the same columns and types as load_frame gives, except
+    that the station table of the categoricals is per chunk.
+    INPUT:
+        csv_path (str) - path of the city csv file
+        chunksize (int) - number of csv rows read at a time
+        month (int) - month number (1 to 12), or None for every month
+        weekday (int) - day of the week (Monday is 0), or None for every day
+    OUTPUTS:
+        yields dataframes of the matching trips
+    """
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        chunk = add_time_columns(parse_trips(chunk))
+        if month is not None:
+            chunk = chunk[chunk['month'] == month]
+        if weekday is not None:
+            chunk = chunk[chunk['day_of_week'].cat.codes == weekday]
+        if len(chunk):
+            yield compact_types(chunk.copy())
+
+
+def concat_trips(*frames):
+    """Concatenate dataframes of trips in the compact schema.
+
+    The categories are merged first so the result keeps categorical columns
+    and the one sorted station table of Start and End Station.
+    """
+    groups = [STATION_COLUMNS] + [[column] for column in CATEGORY_COLUMNS if column in frames[0].columns]
+    frames = [df.copy() for df in frames]
+    for columns in groups:
+        categories = pd.Index([])
+        for df in frames:
+            categories = categories.union(df[columns[0]].cat.categories)
+        for df in frames:
+            for column in columns:
+                df[column] = df[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def validate_trips(rows, columns):
+    """Check new trips against the columns of a city csv file.
+    INPUT:
+        rows - dataframe of new trips, with the csv columns except 'Unnamed: 0'
+        columns (list) - the columns of the city csv file
+    OUTPUTS:
+        rows - the trips with the csv columns in order, timestamps and numbers parsed
+    Raises ValueError when a column is missing or unknown, or a value does not parse.
+    """
+    expected = [column for column in columns if column != 'Unnamed: 0']
+    missing = [column for column in expected if column not in rows.columns]
+    unknown = [column for column in rows.columns if column not in columns]
+    if missing or unknown:
+        raise ValueError('Trips do not match the columns of the city data, missing {}, unknown {}'.format(missing, unknown))
+
+    rows = rows.reindex(columns=list(columns)).reset_index(drop=True)
+    for column in TIME_COLUMNS:
+        parsed = decode_timestamps(rows[column], errors='coerce')[0]
+        if parsed.isna().any():
+            raise ValueError('Invalid or missing {} in rows {}'.format(column, list(np.flatnonzero(parsed.isna()))))
+        rows[column] = parsed
+    for column in NUMERIC_COLUMNS:
+        if column in rows.columns:
+            parsed = pd.to_numeric(rows[column], errors='coerce')
+            invalid = parsed.isna() & rows[column].notna()
+            if invalid.any():
+                raise ValueError('Invalid {} in rows {}'.format(column, list(np.flatnonzero(invalid))))
+            rows[column] = parsed
+    if rows['Trip Duration'].isna().any():
+        raise ValueError('Missing Trip Duration in rows {}'.format(list(np.flatnonzero(rows['Trip Duration'].isna()))))
+    return rows
+
+
+@profiling.timed('bucket_sort')
+def sort_into_buckets(df):
+    """Sort trips by (month, day of week) and index where each bucket starts.
+    INPUT:
+        df - dataframe with the month column and a datetime Start Time
+    OUTPUTS:
+        df - the trips ordered by bucket, by start time inside a bucket
+        offsets (list) - bucket b = (month - 1) * 7 + weekday (Monday is 0)
+            holds rows offsets[b] to offsets[b + 1]
+    """
+    bucket = (df['month'].to_numpy(dtype=np.int64) - 1) * NUM_WEEKDAYS + df['day_of_week'].cat.codes.to_numpy()
+    order = np.lexsort((df['Start Time'].to_numpy(), bucket))
+    df = df.take(order).reset_index(drop=True)
+    counts = np.bincount(bucket, minlength=NUM_BUCKETS)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return df, offsets.tolist()
+
+
+def bucket_ranges(offsets, month=None, weekday=None):
+    """Get the row ranges of the cached data matching a month and weekday.
+    INPUT:
+        offsets (list) - bucket offsets written by sort_into_buckets
+        month (int) - month number (1 to 12), or None for every month
+        weekday (int) - day of the week (Monday is 0), or None for every day
+    OUTPUTS:
+        ranges (list) - (start, stop) row ranges, adjacent ranges merged
+    """
+    months = range(1, NUM_MONTHS + 1) if month is None else [month]
+    weekdays = range(NUM_WEEKDAYS) if weekday is None else [weekday]
+    ranges = []
+    for m in months:
+        for w in weekdays:
+            bucket = (m - 1) * NUM_WEEKDAYS + w
+            start, stop = offsets[bucket], offsets[bucket + 1]
+            if start == stop:
+                continue
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop)
+            else:
+                ranges.append((start, stop))
+    return ranges
+
+
+def selected_offsets(offsets, month=None, weekday=None):
+    """Get the bucket offsets of the rows read with bucket_ranges(offsets, month, weekday)."""
+    months = range(1, NUM_MONTHS + 1) if month is None else [month]
+    weekdays = range(NUM_WEEKDAYS) if weekday is None else [weekday]
+    sizes = np.zeros(NUM_BUCKETS, dtype=np.int64)
+    for m in months:
+        for w in weekdays:
+            bucket = (m - 1) * NUM_WEEKDAYS + w
+            sizes[bucket] = offsets[bucket + 1] - offsets[bucket]
+    return np.concatenate([[0], np.cumsum(sizes)]).tolist()
+
+
+def _tmp_path(path):
+    # Unique per writer so concurrent rebuilds do not clobber each other
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+def write_atomically(path, write):
+    """Call write(tmp_path) and move the written file to path in one step,
+    so readers never see a half written file."""
+    tmp_path = _tmp_path(path)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json(path, content):
+    """Write a json file atomically."""
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(content, f)
+    write_atomically(path, write)
+
+
+def read_json(path):
+    """Read a json file, None when it is missing or corrupt."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+@profiling.timed()
+def build_cache(csv_path):
+    """Convert a city csv file into its columnar cache.
+    INPUT:
+        csv_path (str) - path of the city csv file
+    OUTPUTS:
+        df - the parsed dataframe that was written to the cache
+        meta (dict) - the description of the cache, with the bucket offsets
+    """
+    data_path, meta_path = cache_paths(csv_path)
+    # Take the signature before reading so a concurrent rewrite of the csv
+    # makes the cache look stale rather than fresh
+    signature = source_signature(csv_path)
+    digest = file_digest(csv_path, 0, signature['size'])
+    with profiling.span('csv_read') as span:
+        raw = pd.read_csv(csv_path)
+        span.rows = len(raw)
+    df = prepare_trips(raw)
+    fallbacks = df.attrs.get('time_fallbacks', 0)
+    df, offsets = sort_into_buckets(df)
+    meta = dict(signature, sha1=digest, parts=[[signature['size'], digest]], schema_version=SCHEMA_VERSION,
+                offsets=offsets, segments=[], time_fallbacks=fallbacks)
+
+    try:
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        write_atomically(data_path, df.to_feather)
+        write_json(meta_path, meta)
+    except (ImportError, OSError):
+        # pyarrow is not installed or the cache folder is not writable
+        # (read-only, full disk), go without the cache
+        return df, meta
+    _remove_segments(csv_path)
+    return df, meta
+
+
+def read_fresh_meta(csv_path):
+    """Get the description of the columnar cache of a csv file if it is valid.
+
+    Returns None when the cache has to be rebuilt. The cache is valid when it was written with the current schema and the
+    csv file has the same size and modification time. If only the
+    modification time changed, the content hash decides and the stored
+    signature is refreshed so the hash is not recomputed next time.
+    """
+    data_path, meta_path = cache_paths(csv_path)
+    meta = read_json(meta_path)
+    if meta is None or meta.get('schema_version') != SCHEMA_VERSION:
+        return None
+    if not os.path.exists(data_path):
+        return None
+
+    signature = source_signature(csv_path)
+    if all(meta.get(key) == value for key, value in signature.items()):
+        return meta
+    if meta.get('size') != signature['size'] or meta.get('sha1') != content_version(csv_path, meta['parts']):
+        return None
+    # The file was touched but its content is unchanged
+    meta.update(signature)
+    try:
+        write_json(meta_path, meta)
+    except OSError:
+        # Read-only cache folder, the hash is checked again next time
+        pass
+    return meta
+
+
+def _segment_paths(csv_path, meta):
+    # Paths and bucket offsets of the segment files of the appended trips
+    folder = os.path.dirname(cache_paths(csv_path)[0])
+    return [(os.path.join(folder, segment['file']), segment['offsets']) for segment in meta.get('segments', [])]
+
+
+def _remove_segments(csv_path, keep=()):
+    # Segment files are named <stem>.append-<version>.feather
+    data_path = cache_paths(csv_path)[0]
+    folder = os.path.dirname(data_path)
+    prefix = os.path.splitext(os.path.basename(data_path))[0] + '.append-'
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name.endswith('.feather') and name not in keep:
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+
+
+def append_trips(csv_path, rows):
+    """Add new trips to a city csv file and to its columnar cache.
+
+    The rows are appended to the csv file. When the cache was up to date
+    the new trips are sorted into buckets and written to a segment file of
+    their own, which the loads merge with the cached data bucket by bucket.
+    The version (sha1) of the data is chained from the previous version and
+    the hash of the appended bytes only, so an append costs the size of the
+    new trips, not of the city. Once the segments hold MAX_SEGMENT_SHARE of
+    the cached rows, or there are more than MAX_SEGMENTS of them, they are
+    merged into the cache. Without a fresh cache, the cache is rebuilt as
+    usual on the next load.
+    INPUT:
+        csv_path (str) - path of the city csv file
+        rows - dataframe of new trips, see validate_trips
+    OUTPUTS:
+        new - the new trips in the compact schema
+        meta (dict) - the updated description of the cache, None without a cache
+    """
+    rows = validate_trips(rows, pd.read_csv(csv_path, nrows=0).columns)
+    meta = read_fresh_meta(csv_path)
+
+    with open(csv_path, 'rb+') as f:
+        # Start on a new line if the last line has no line break
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+    rows.to_csv(csv_path, mode='a', header=False, index=False)
+    new = prepare_trips(rows.copy())
+    if meta is None:
+        return new, None
+
+    data_path, meta_path = cache_paths(csv_path)
+    signature = source_signature(csv_path)
+    digest = file_digest(csv_path, meta['size'], signature['size'])
+    version = chain_digest(meta['sha1'], digest)
+    segment, offsets = sort_into_buckets(new)
+    name = '{}.append-{}.feather'.format(os.path.splitext(os.path.basename(data_path))[0], version[:16])
+    write_atomically(os.path.join(os.path.dirname(data_path), name), segment.to_feather)
+
+    meta = dict(meta, sha1=version, parts=meta['parts'] + [[signature['size'], digest]],
+                segments=meta.get('segments', []) + [{'file': name, 'offsets': offsets}],
+                time_fallbacks=meta.get('time_fallbacks', 0) + new.attrs.get('time_fallbacks', 0))
+    meta.update(signature)
+    appended = sum(segment['offsets'][-1] for segment in meta['segments'])
+    if len(meta['segments']) > MAX_SEGMENTS or appended > MAX_SEGMENT_SHARE * meta['offsets'][-1]:
+        # Merge the segments back into the cache
+        df, offsets = _read_cached(csv_path, meta)
+        write_atomically(data_path, df.to_feather)
+        meta.update(offsets=offsets, segments=[])
+    write_json(meta_path, meta)
+    _remove_segments(csv_path, keep=[segment['file'] for segment in meta['segments']])
+    return new, meta
+
+
+def _merge_segments(pieces):
+    """Merge bucket ordered frames of trips into one bucket ordered frame.
+    INPUT:
+        pieces (list) - (df, offsets) of the cached data and of every segment
+    OUTPUTS:
+        df - the trips of every piece, by bucket and by start time inside a
+            bucket, like sort_into_buckets orders them
+        offsets (list) - the bucket offsets of df
+    """
+    if len(pieces) == 1:
+        return pieces[0]
+    df = concat_trips(*[piece for piece, _ in pieces])
+    times = df['Start Time'].to_numpy()
+    starts = np.cumsum([0] + [len(piece) for piece, _ in pieces])
+    order, offsets = [], [0]
+    for b in range(NUM_BUCKETS):
+        rows = [np.arange(start + piece_offsets[b], start + piece_offsets[b + 1])
+                for start, (_, piece_offsets) in zip(starts, pieces) if piece_offsets[b + 1] > piece_offsets[b]]
+        if len(rows) > 1:
+            # Only the buckets holding appended trips are sorted again
+            rows = np.concatenate(rows)
+            rows = [rows[np.argsort(times[rows], kind='mergesort')]]
+        order.extend(rows)
+        offsets.append(offsets[-1] + sum(len(bucket_rows) for bucket_rows in rows))
+    return df.take(np.concatenate(order + [np.zeros(0, dtype=np.int64)])).reset_index(drop=True), offsets
+
+
+def _read_cached(csv_path, meta, month=None, weekday=None):
+    # The cached trips of a month and weekday merged with the appended ones, and their offsets
+    pieces = []
+    for path, offsets in [(cache_paths(csv_path)[0], meta['offsets'])] + _segment_paths(csv_path, meta):
+        if month is None and weekday is None:
+            pieces.append((pd.read_feather(path), offsets))
+        else:
+            pieces.append((_read_ranges(path, bucket_ranges(offsets, month, weekday)),
+                           selected_offsets(offsets, month, weekday)))
+    return _merge_segments(pieces)
+
+
+def _read_ranges(data_path, ranges):
+    # Memory map the feather file so only the requested rows are materialised
+    from pyarrow import feather
+    import pyarrow as pa
+
+    table = feather.read_table(data_path, memory_map=True)
+    pieces = [table.slice(start, stop - start) for start, stop in ranges]
+    return pa.concat_tables(pieces or [table.slice(0, 0)]).to_pandas()
+
+
+# Hashes of the csv files without a cache description (unwritable cache
+# folder): absolute csv path -> ((size, mtime_ns), sha1)
+_DIGESTS = {}
+
+
+def dataset_version(csv_path):
+    """Get the sha1 hash of the content of a csv file, from the cache description when it is fresh."""
+    meta = read_fresh_meta(csv_path)
+    if meta is not None:
+        return meta['sha1']
+    # Hash the file once per version of it, later calls only stat it
+    stat = os.stat(csv_path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    known = _DIGESTS.get(os.path.abspath(csv_path))
+    if known is None or known[0] != signature:
+        known = signature, file_digest(csv_path)
+        _DIGESTS[os.path.abspath(csv_path)] = known
+    return known[1]
+
+
+def cache_folder(csv_path):
+    """Get the folder holding the caches of a csv file."""
+    return os.path.dirname(cache_paths(csv_path)[0])
+
+
+def ensure_cache(csv_path):
+    """Build the columnar cache of a csv file unless it is up to date.
+    OUTPUTS:
+        meta (dict) - the description of the cache, with the bucket offsets
+    """
+    meta = read_fresh_meta(csv_path)
+    if meta is None:
+        meta = build_cache(csv_path)[1]
+    return meta
+
+
+def load_indexed(csv_path):
+    """Load all the trips of a city together with the description of their buckets.
+    INPUT:
+        csv_path (str) - path of the city csv file
+    OUTPUTS:
+        df - Pandas DataFrame of all the trips, ordered by bucket
+        meta (dict) - the description of the cache, with the bucket offsets
+    """
+    meta = read_fresh_meta(csv_path)
+    if meta is not None:
+        df, offsets = _read_cached(csv_path, meta)
+        return df, dict(meta, offsets=offsets)
+    return build_cache(csv_path)
+
+
+@profiling.timed('filter')
+def take_buckets(df, offsets, month=None, weekday=None):
+    """Select the trips of a month and weekday from a frame ordered by bucket.
+
+    A single range of rows (any month/day filter but a day of every month)
+    is a slice of df, without copying it.
+    """
+    if month is None and weekday is None:
+        return df
+    ranges = bucket_ranges(offsets, month, weekday)
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        return df.iloc[start:stop]
+    rows = [np.arange(start, stop) for start, stop in ranges]
+    return df.take(np.concatenate(rows) if rows else [])
+
+
+@profiling.timed()
+def load_frame(csv_path, month=None, weekday=None):
+    """Load the trips of a city, from the columnar cache when possible.
+
+    Only the bucket rows matching the month and weekday are read, so no
+    filtering has to be done on the whole table.
+    INPUT:
+        csv_path (str) - path of the city csv file
+        month (int) - month number (1 to 12), or None for every month
+        weekday (int) - day of the week (Monday is 0), or None for every day
+    OUTPUTS:
+        df - Pandas DataFrame of the matching trips, ordered by month, day of
+            the week and start time
+    """
+    meta = read_fresh_meta(csv_path)
+    if meta is not None:
+        return _read_cached(csv_path, meta, month, weekday)[0]
+
+    df, meta = build_cache(csv_path)
+    return take_buckets(df, meta['offsets'], month, weekday).reset_index(drop=True)
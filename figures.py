@@ -0,0 +1,123 @@
+"""Charts of the statistics, built only when they are shown.
+
+The statistics functions return plain data. The figure functions below
+take that data and return a LazyFigure, which imports plotly and builds
+the chart the first time it is used (shown, drawn by streamlit, ...).
+"""
+
+
+class LazyFigure:
+    """A plotly figure built on first access.
+
+    .figure builds (once) and returns the plotly figure, any other
+    attribute (show, update_layout, to_json, ...) is taken from it.
+    """
+
+    def __init__(self, build, *args, **kwargs):
+        self._build = build
+        self._args = args
+        self._kwargs = kwargs
+        self._figure = None
+
+    @property
+    def built(self):
+        """Whether the figure was built already."""
+        return self._figure is not None
+
+    @property
+    def figure(self):
+        if self._figure is None:
+            self._figure = self._build(*self._args, **self._kwargs)
+        return self._figure
+
+    def __getattr__(self, name):
+        # Only called for attributes LazyFigure does not have itself
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.figure, name)
+
+    def __getstate__(self):
+        # Pickle the recipe, not the built figure
+        return {'_build': self._build, '_args': self._args, '_kwargs': self._kwargs, '_figure': None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def _lines(curves, columns, title):
+    import plotly.express as px
+    return px.line(curves, y=columns, title=title)
+
+
+def _bar(df, x, title):
+    import plotly.express as px
+    return px.bar(df, y="frequency", x=x, color=x, title=title)
+
+
+def _histogram(counts, title):
+    import plotly.express as px
+    return px.bar(x=counts.index, y=counts.to_numpy(), labels={'x': counts.index.name, 'y': 'frequency'},
+                  title=title)
+
+
+def _bins(histogram, title):
+    import plotly.express as px
+    # The last bin is open, it holds every trip longer than its low end
+    labels = ['{:.0f}-{:.0f}'.format(low, high) for low, high in zip(histogram['low'], histogram['high'])]
+    labels[-1] = '{:.0f}+'.format(histogram['low'].iloc[-1])
+    return px.bar(x=labels, y=histogram['frequency'], labels={'x': 'duration', 'y': 'frequency'}, title=title)
+
+
+def _grouped_bars(df, title):
+    import plotly.express as px
+    return px.bar(df.T, barmode='group', labels={'index': 'city', 'value': 'seconds'}, title=title)
+
+
+def _pie(df, names, title):
+    import plotly.express as px
+    return px.pie(df, values='frequency', names=names, title=title)
+
+
+def user_types_bar(df_user_type):
+    """Bar chart of the user type counts (user_types and frequency columns)."""
+    return LazyFigure(_bar, df_user_type, "user_types", "The Bikeshare for the User Types ")
+
+
+def user_types_pie(df_user_type):
+    """Pie chart of the user type counts (user_types and frequency columns)."""
+    return LazyFigure(_pie, df_user_type, "user_types", "The Bikesare User Types")
+
+
+def gender_pie(gender):
+    """Pie chart of the gender counts (gender and frequency columns)."""
+    return LazyFigure(_pie, gender, "gender", "The Bikesare Users By Gender")
+
+
+def birth_years_bar(birth_years):
+    """Bar chart of the trips per year of birth (Series indexed by year)."""
+    return LazyFigure(_histogram, birth_years, "Trips by Year of Birth of the Users")
+
+
+def duration_histogram(histogram):
+    """Bar chart of the trips per duration bin (low, high and frequency columns)."""
+    return LazyFigure(_bins, histogram, "Trips by Duration in Seconds")
+
+
+def popular_trips_bar(df_pop_trip, city):
+    """Bar chart of the most popular trips (trips and frequency columns) of a city."""
+    return LazyFigure(_bar, df_pop_trip, "trips", "10 Most popular trips in {}".format(city))
+
+
+def popular_trips_pie(df_pop_trip):
+    """Pie chart of the most popular trips (trips and frequency columns)."""
+    return LazyFigure(_pie, df_pop_trip, "trips", "The 10 most Popular Trips")
+
+
+def city_comparison(comparison, metrics, title):
+    """Grouped bar chart of metrics (rows of bikeshare.compare_cities) per city."""
+    return LazyFigure(_grouped_bars, comparison.loc[list(metrics)].astype(float), title)
+
+
+def trips_over_time(curves, columns, title):
+    """Line chart of columns of the time series of timeseries.rollup."""
+    return LazyFigure(_lines, curves, list(columns), title)
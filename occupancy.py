@@ -0,0 +1,236 @@
+"""Bikes in use at once and the net flow of bikes per station.
+
+Every trip is a +1 event at its Start Time and a -1 event at its End Time.
+The events are sorted once and a cumulative sum over them gives the number
+of bikes in use after every event (a sweep line), without comparing trips
+with each other. Trips are selected like load_data does, by the month and
+day of week of their Start Time, and optionally by a range of Start Times.
+"""
+import numpy as np
+import pandas as pd
+
+import datastore
+import profiling
+import timeseries
+from bikeshare import load_data, open_store, filter_numbers
+
+
+def _valid_times(df):
+    # Start and end of every trip as int64 nanoseconds, and which trips have
+    # both and do not end before they start
+    starts = df['Start Time'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    ends = df['End Time'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    nat = np.iinfo(np.int64).min
+    return starts, ends, (starts != nat) & (ends != nat) & (ends >= starts)
+
+
+def _trip_times(df):
+    # Start and end of the valid trips as int64 nanoseconds
+    starts, ends, valid = _valid_times(df)
+    return starts[valid], ends[valid]
+
+
+class Sweep:
+    """Number of bikes in use after every start or end of a trip.
+
+    times holds the distinct event times (int64 nanoseconds, sorted) and
+    in_use the number of bikes in use from that time on. A bike returned at
+    the very time another one is taken is counted once.
+    """
+
+    def __init__(self, times, in_use):
+        self.times = times
+        self.in_use = in_use
+
+    @classmethod
+    def from_frame(cls, df):
+        starts, ends = _trip_times(df)
+        # Ends first so they come before the starts of the same time
+        times = np.concatenate([ends, starts])
+        deltas = np.concatenate([np.full(len(ends), -1, dtype=np.int64), np.ones(len(starts), dtype=np.int64)])
+        order = np.argsort(times, kind='stable')
+        times, in_use = times[order], np.cumsum(deltas[order])
+        # Keep the count after the last event of every distinct time
+        last = np.append(times[1:] != times[:-1], True) if len(times) else np.zeros(0, dtype=bool)
+        return cls(times[last], in_use[last])
+
+    def at(self, times):
+        """Get the number of bikes in use at given times (datetime64 values)."""
+        times = np.asarray(times, dtype='datetime64[ns]').view(np.int64)
+        position = np.searchsorted(self.times, times, side='right') - 1
+        return np.where(position >= 0, self.in_use[np.maximum(position, 0)], 0)
+
+    def frame(self, start=None, end=None):
+        """Get the step curve between start (included) and end (excluded) as a dataframe.
+
+        The first row is the number of bikes in use at start.
+        """
+        times, in_use = self.times, self.in_use
+        if start is not None:
+            start = np.datetime64(pd.Timestamp(start), 'ns').astype(np.int64)
+            first = np.searchsorted(times, start, side='right')
+            times = np.concatenate([[start], times[first:]])
+            in_use = np.concatenate([[self.in_use[first - 1] if first else 0], in_use[first:]])
+        if end is not None:
+            end = np.datetime64(pd.Timestamp(end), 'ns').astype(np.int64)
+            keep = times < end
+            times, in_use = times[keep], in_use[keep]
+        return pd.DataFrame({'in_use': in_use}, index=pd.DatetimeIndex(times.view('datetime64[ns]'), name='time'))
+
+    def peak(self):
+        """Get the most bikes in use at once and the first time it happened."""
+        if len(self.in_use) == 0:
+            return 0, None
+        position = self.in_use.argmax()
+        return int(self.in_use[position]), pd.Timestamp(self.times[position])
+
+
+@profiling.timed()
+def fleet_in_use(df, freq='hour'):
+    """Get the bikes in use per time bucket.
+    INPUTS:
+        df - dataframe of trips
+        freq (str) - granularity, one of timeseries.FREQUENCIES
+    OUTPUTS:
+        fleet - dataframe indexed by the start of the buckets, from the first
+            start to the last end of a trip, with the in_use (at the start of
+            the bucket) and peak (most at once during the bucket) columns
+    """
+    sweep = Sweep.from_frame(df)
+    if len(sweep.times) == 0:
+        return pd.DataFrame({'in_use': [], 'peak': []}, index=timeseries.bucket_starts([], freq))
+    buckets = timeseries.epoch_buckets(sweep.times.view('datetime64[ns]'), freq)
+    first = buckets[0]
+    size = int(buckets[-1] - first) + 1
+    starts = timeseries.bucket_starts(np.arange(first, first + size), freq)
+
+    in_use = sweep.at(starts)
+    peak = in_use.copy()
+    np.maximum.at(peak, buckets - first, sweep.in_use)
+    return pd.DataFrame({'in_use': in_use, 'peak': peak}, index=starts)
+
+
+def _station_counts(position, codes, num_stations):
+    # Distinct (time bucket, station) keys and their trip counts
+    valid = codes >= 0
+    return np.unique(position[valid] * num_stations + codes[valid], return_counts=True)
+
+
+@profiling.timed()
+def station_flow(df, freq='hour'):
+    """Get the arrivals, departures and net flow of bikes of the stations per time bucket.
+    INPUTS:
+        df - dataframe of trips
+        freq (str) - granularity, one of timeseries.FREQUENCIES
+    OUTPUTS:
+        flow - dataframe with one row per time bucket and station with at
+            least one trip, ordered by time and station: the time (start of
+            the bucket), station, arrivals, departures and net (arrivals minus
+            departures) columns. The cumulative sum of the net of a station
+            over its rows is its running balance.
+    """
+    start, end, stations = datastore.station_codes(df)
+    # The trips fleet_in_use counts, a missing end time has no bucket
+    starts, ends, valid = _valid_times(df)
+    start, end = start[valid], end[valid]
+    departures = timeseries.epoch_buckets(starts[valid].view('datetime64[ns]'), freq)
+    arrivals = timeseries.epoch_buckets(ends[valid].view('datetime64[ns]'), freq)
+    first = min(departures.min(), arrivals.min()) if len(departures) else 0
+
+    # Only the (time bucket, station) pairs with trips, never buckets x stations
+    arrival_keys, arrival_counts = _station_counts(arrivals - first, end, len(stations))
+    departure_keys, departure_counts = _station_counts(departures - first, start, len(stations))
+    keys = np.union1d(arrival_keys, departure_keys)
+    counts = np.zeros((2, len(keys)), dtype=np.int64)
+    counts[0, np.searchsorted(keys, arrival_keys)] = arrival_counts
+    counts[1, np.searchsorted(keys, departure_keys)] = departure_counts
+
+    position, codes = np.divmod(keys, max(len(stations), 1))
+    return pd.DataFrame({'time': timeseries.bucket_starts(position + first, freq),
+                         'station': np.asarray(stations, dtype=object)[codes],
+                         'arrivals': counts[0],
+                         'departures': counts[1],
+                         'net': counts[0] - counts[1]})
+
+
+def station_balance(df):
+    """Get the departures, arrivals and net flow of every station over the whole period.
+    OUTPUTS:
+        balance - dataframe indexed by station, the stations losing the most
+            bikes first
+    """
+    start, end, stations = datastore.station_codes(df)
+    departures = np.bincount(start[start >= 0], minlength=len(stations))
+    arrivals = np.bincount(end[end >= 0], minlength=len(stations))
+    balance = pd.DataFrame({'departures': departures, 'arrivals': arrivals, 'net': arrivals - departures},
+                           index=pd.Index(np.asarray(stations, dtype=object), name='station'))
+    return balance.sort_values('net', kind='mergesort')
+
+
+def _range_buckets(start, end, month=None, weekday=None):
+    # month -> weekdays of the days from start to end (excluded), within a month/day filter
+    last = pd.Timestamp(end) - pd.Timedelta(1, 'ns')
+    days = pd.date_range(pd.Timestamp(start).normalize(), last.normalize(), freq='D')
+    buckets = {}
+    for day_month, day_weekday in sorted(set(zip(days.month, days.weekday))):
+        if month in (None, day_month) and weekday in (None, day_weekday):
+            buckets.setdefault(day_month, []).append(day_weekday)
+    return buckets
+
+
+def load_range(city, month, day, start=None, end=None):
+    """Load the trips of a city filtered like load_data, and started from start to end (excluded).
+
+    With both ends of the range, only the (month, day of week) buckets of the
+    days of the range are read, a week of trips costs a week of rows
+    whatever the size of the city.
+    INPUTS:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        start, end - anything pd.Timestamp takes, None for no bound
+    OUTPUTS:
+        df - Pandas DataFrame of the matching trips
+    """
+    if start is None or end is None:
+        df = load_data(city, month, day)
+    else:
+        month, weekday = filter_numbers(month, day)
+        store = open_store(city)
+        parts = []
+        for part_month, weekdays in _range_buckets(start, end, month, weekday).items():
+            if len(weekdays) == datastore.NUM_WEEKDAYS:
+                parts.append(store.load(part_month, None))
+            else:
+                parts.extend(store.load(part_month, part_weekday) for part_weekday in weekdays)
+        if not parts:
+            # No day of the range passes the filter, any bucket gives the columns
+            parts = [store.load(month or 1, weekday or 0).iloc[:0]]
+        df = datastore.concat_trips(*parts) if len(parts) > 1 else parts[0]
+
+    if start is not None or end is not None:
+        times = df['Start Time']
+        keep = np.ones(len(df), dtype=bool)
+        if start is not None:
+            keep &= (times >= pd.Timestamp(start)).to_numpy()
+        if end is not None:
+            keep &= (times < pd.Timestamp(end)).to_numpy()
+        df = df[keep].reset_index(drop=True)
+    return df
+
+
+def city_occupancy(city, month, day, freq='hour', start=None, end=None):
+    """Get the bikes in use and the net flow per station of a city, filtered like load_data.
+    INPUTS:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        freq (str) - granularity, one of timeseries.FREQUENCIES
+        start, end - range of the Start Times of the trips (end excluded),
+            None for no bound, see load_range
+    OUTPUTS:
+        fleet - see fleet_in_use
+        flow - see station_flow
+    """
+    df = load_range(city, month, day, start, end)
+    return fleet_in_use(df, freq), station_flow(df, freq)
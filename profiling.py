@@ -0,0 +1,183 @@
+"""Lightweight timing spans for the hot paths of loading and the statistics.
+
+Wrap a stage in a span to record its duration, the number of rows it
+handled and how much the resident memory grew:
+
+    with profiling.span('csv_read') as s:
+        df = pd.read_csv(path)
+        s.rows = len(df)
+
+    @profiling.timed()
+    def station_stats(df, num_stations=10): ...
+
+Spans are kept in the in-process REGISTRY, which can be dumped as JSON
+lines or as Prometheus text. Set BIKESHARE_PROFILE=0 to turn recording off.
+"""
+import os
+import json
+import time
+import functools
+import threading
+from collections import deque
+
+# Number of recent spans kept, the totals per name are kept for every span
+MAX_SPANS = 10000
+ENABLED = os.environ.get('BIKESHARE_PROFILE', '1') != '0'
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = None
+
+
+def current_rss():
+    """Get the resident memory of the process in bytes, None where /proc is not available."""
+    if _PAGE_SIZE is None:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Span:
+    """One timed run of a stage."""
+
+    __slots__ = ('name', 'seq', 'thread', 'start', 'duration', 'rows', 'memory_delta', 'parent')
+
+    def __init__(self, name, seq, parent=None):
+        self.name = name
+        self.seq = seq
+        self.thread = threading.get_ident()
+        self.start = time.time()
+        self.duration = None
+        self.rows = None
+        self.memory_delta = None
+        self.parent = parent
+
+    def as_dict(self):
+        return {'name': self.name, 'seq': self.seq, 'thread': self.thread, 'parent': self.parent,
+                'start': self.start, 'duration_s': self.duration, 'rows': self.rows,
+                'memory_delta_bytes': self.memory_delta}
+
+
+class Registry:
+    """Thread-safe store of the recent spans and of the totals per span name."""
+
+    def __init__(self, max_spans=MAX_SPANS):
+        self.spans = deque(maxlen=max_spans)
+        self.totals = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def next_seq(self):
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+            total = self.totals.setdefault(span.name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0})
+            total['count'] += 1
+            total['seconds'] += span.duration
+            total['max_seconds'] = max(total['max_seconds'], span.duration)
+            total['rows'] += span.rows or 0
+
+    def since(self, seq, thread=None):
+        """Get the spans started after the sequence number seq, of one thread if given."""
+        with self._lock:
+            return [span for span in self.spans
+                    if span.seq > seq and (thread is None or span.thread == thread)]
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+            self.totals.clear()
+
+    def to_jsonl(self, path):
+        """Append the recent spans to a JSON lines file, one span per line."""
+        with self._lock:
+            spans = list(self.spans)
+        with open(path, 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span.as_dict()) + '\n')
+
+    def prometheus_text(self, prefix='bikeshare'):
+        """Get the totals per span name in the Prometheus text exposition format."""
+        with self._lock:
+            totals = {name: dict(total) for name, total in self.totals.items()}
+        lines = []
+        for metric, key, kind, help_text in (
+                ('span_calls_total', 'count', 'counter', 'Number of runs of the stage.'),
+                ('span_seconds_total', 'seconds', 'counter', 'Total time spent in the stage.'),
+                ('span_seconds_max', 'max_seconds', 'gauge', 'Longest run of the stage.'),
+                ('span_rows_total', 'rows', 'counter', 'Rows handled by the stage.')):
+            name = '{}_{}'.format(prefix, metric)
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for span_name in sorted(totals):
+                lines.append('{}{{span="{}"}} {}'.format(name, span_name, totals[span_name][key]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class span:
+    """Context manager timing a stage into REGISTRY, set .rows on the yielded Span."""
+
+    def __init__(self, name, rows=None, registry=None):
+        self.name = name
+        self.rows = rows
+        self.registry = registry or REGISTRY
+        self._span = None
+
+    def __enter__(self):
+        registry = self.registry
+        stack = getattr(registry._local, 'stack', None)
+        if stack is None:
+            stack = registry._local.stack = []
+        parent = stack[-1].name if stack else None
+        self._span = Span(self.name, registry.next_seq(), parent)
+        self._span.rows = self.rows
+        self._rss = current_rss() if ENABLED else None
+        self._clock = time.perf_counter()
+        stack.append(self._span)
+        return self._span
+
+    def __exit__(self, *exc):
+        current = self._span
+        current.duration = time.perf_counter() - self._clock
+        self.registry._local.stack.pop()
+        if ENABLED:
+            if self._rss is not None:
+                rss = current_rss()
+                current.memory_delta = None if rss is None else rss - self._rss
+            self.registry.record(current)
+        return False
+
+
+def _count_rows(args, result):
+    # Rows of the dataframe returned, else of the first dataframe argument
+    for value in (result,) + tuple(args):
+        if hasattr(value, 'columns') and hasattr(value, '__len__'):
+            return len(value)
+    return None
+
+
+def timed(name=None):
+    """Decorate a function to time every call in a span named after it."""
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(label) as current:
+                result = func(*args, **kwargs)
+                current.rows = _count_rows(args, result)
+            return result
+        return wrapper
+    return decorate
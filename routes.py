@@ -0,0 +1,265 @@
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+import datastore
+
+# A trip between two stations and how many times it was made
+Route = namedtuple('Route', ['start', 'end', 'count'])
+# Trips from (to) a station: the other station, the number of trips and
+# their total duration in seconds (None when the durations are not known)
+Flow = namedtuple('Flow', ['station', 'count', 'duration'])
+# Trips between two stations in either direction
+Corridor = namedtuple('Corridor', ['station_a', 'station_b', 'count'])
+
+
+class ODMatrix:
+    """Sparse origin-destination matrix of trip counts between stations.
+
+    Stored in CSR form over the codes of the city station table: the trips
+    starting at station code s end at indices[indptr[s]:indptr[s + 1]],
+    counts[...] times, taking durations[...] seconds in total. Only the
+    routes actually travelled take memory. The column sums and the
+    transposed (by destination) form are built on first use and kept.
+    """
+
+    def __init__(self, indptr, indices, counts, stations, durations=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+        self.stations = stations
+        self.durations = durations
+        self._inflows = None
+        self._by_destination = None
+
+    @classmethod
+    def from_codes(cls, start, end, stations, durations=None):
+        """Build the matrix from the start and end station codes of the trips.
+        INPUTS:
+            start (array) - code of the start station of every trip, -1 if missing
+            end (array) - code of the end station of every trip, -1 if missing
+            stations (Index) - the station names the codes refer to
+            durations (array) - duration of every trip in seconds, optional
+        """
+        num_stations = len(stations)
+        valid = (start >= 0) & (end >= 0)
+        # One integer per (start, end) pair, sorted row by row
+        keys = start[valid].astype(np.int64) * num_stations + end[valid]
+        keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        totals = None
+        if durations is not None:
+            weights = np.nan_to_num(np.asarray(durations, dtype=np.float64)[valid])
+            totals = np.bincount(inverse, weights=weights, minlength=len(keys))
+        rows, indices = np.divmod(keys, num_stations)
+        indptr = np.zeros(num_stations + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_stations), out=indptr[1:])
+        return cls(indptr, indices, counts, stations, totals)
+
+    @classmethod
+    def from_frame(cls, df):
+        """Build the matrix of a dataframe of trips, with their durations."""
+        durations = df['Trip Duration'].to_numpy() if 'Trip Duration' in df.columns else None
+        return cls.from_codes(*datastore.station_codes(df), durations=durations)
+
+    @property
+    def nnz(self):
+        """Number of distinct routes."""
+        return len(self.counts)
+
+    def _rows(self):
+        return np.repeat(np.arange(len(self.stations)), np.diff(self.indptr))
+
+    def _route(self, position):
+        row = np.searchsorted(self.indptr, position, side='right') - 1
+        return Route(self.stations[row], self.stations[self.indices[position]], int(self.counts[position]))
+
+    def top(self, k=10):
+        """Get the k most frequent routes, most frequent first.
+
+        Only the routes at least as frequent as the k-th one are sorted
+        (argpartition), ties are kept in station order.
+        """
+        if k <= 0 or self.nnz == 0:
+            return []
+        if k < self.nnz:
+            threshold = self.counts[np.argpartition(self.counts, self.nnz - k)[self.nnz - k]]
+            candidates = np.flatnonzero(self.counts >= threshold)
+        else:
+            candidates = np.arange(self.nnz)
+        order = candidates[np.lexsort((candidates, -self.counts[candidates]))][:k]
+        return [self._route(position) for position in order]
+
+    def mode(self):
+        """Get the most frequent route (the first one in station order on ties)."""
+        if self.nnz == 0:
+            return None
+        return self._route(self.counts.argmax())
+
+    def code(self, station):
+        """Get the code of a station name, KeyError for an unknown station."""
+        return self.stations.get_loc(station)
+
+    def _flows(self, other_codes, counts, durations, k):
+        # Most frequent first, ties in station order
+        order = np.lexsort((other_codes, -counts))[:k]
+        names = self.stations[other_codes[order]]
+        totals = [None] * len(order) if durations is None else durations[order].tolist()
+        return [Flow(*flow) for flow in zip(names, counts[order].tolist(), totals)]
+
+    def destinations(self, station, k=None):
+        """Get where the trips from a station go, most frequent first.
+        INPUTS:
+            station (str) - name of the start station
+            k (int) - number of destinations to return, all of them by default
+        OUTPUTS:
+            destinations (list) - Flow(end station, count, total duration) tuples,
+                pd.DataFrame(destinations) makes a table of them
+        """
+        row = self.code(station)
+        part = slice(self.indptr[row], self.indptr[row + 1])
+        durations = None if self.durations is None else self.durations[part]
+        return self._flows(self.indices[part], self.counts[part], durations, k)
+
+    def _transpose(self):
+        # CSC form: the routes ordered by destination, then by origin
+        if self._by_destination is None:
+            rows = self._rows()
+            order = np.lexsort((rows, self.indices))
+            indptr = np.zeros(len(self.stations) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.indices, minlength=len(self.stations)), out=indptr[1:])
+            self._by_destination = (indptr, rows[order], order)
+        return self._by_destination
+
+    def origins(self, station, k=None):
+        """Get where the trips to a station come from, most frequent first.
+        OUTPUTS:
+            origins (list) - Flow(start station, count, total duration) tuples
+        """
+        indptr, rows, order = self._transpose()
+        column = self.code(station)
+        part = order[indptr[column]:indptr[column + 1]]
+        durations = None if self.durations is None else self.durations[part]
+        return self._flows(rows[indptr[column]:indptr[column + 1]], self.counts[part], durations, k)
+
+    def outflow(self, station):
+        """Number of trips starting at a station."""
+        row = self.code(station)
+        return int(self.counts[self.indptr[row]:self.indptr[row + 1]].sum())
+
+    def inflow(self, station):
+        """Number of trips ending at a station."""
+        if self._inflows is None:
+            self._inflows = np.bincount(self.indices, weights=self.counts,
+                                        minlength=len(self.stations)).astype(np.int64)
+        return int(self._inflows[self.code(station)])
+
+    def busiest_corridors(self, k=10):
+        """Get the pairs of stations with the most trips between them, both ways together.
+
+        Round trips (start and end at the same station) are corridors of
+        one station.
+        OUTPUTS:
+            corridors (list) - Corridor(station_a, station_b, count) tuples,
+                station_a first in station order, most trips first
+        """
+        if self.nnz == 0 or k <= 0:
+            return []
+        rows = self._rows()
+        low, high = np.minimum(rows, self.indices), np.maximum(rows, self.indices)
+        keys, inverse = np.unique(low * len(self.stations) + high, return_inverse=True)
+        counts = np.bincount(inverse, weights=self.counts).astype(np.int64)
+        order = np.lexsort((keys, -counts))[:k]
+        low, high = np.divmod(keys[order], len(self.stations))
+        return [Corridor(self.stations[a], self.stations[b], int(count))
+                for a, b, count in zip(low, high, counts[order])]
+
+    def __getstate__(self):
+        # The lazily built lookups are rebuilt after unpickling
+        state = dict(self.__dict__)
+        state['_inflows'] = state['_by_destination'] = None
+        return state
+
+
+class SpaceSaving:
+    """Approximate counts of the most frequent keys of a stream in bounded memory.
+
+    Keeps at most capacity counters (Space-Saving). Counts are fed in batches
+    (e.g. the route counts of one chunk of trips) and summaries of separate
+    streams can be merged. Every reported count over-estimates the true count
+    by at most floor, and any key occurring more than floor times is kept.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype=np.int64)
+        self.floor = 0
+
+    def _combine(self, counts, floor):
+        # A key missing from one summary occurred at most that summary's floor times
+        both = pd.concat([self.counts, counts], axis=1)
+        total = both.iloc[:, 0].fillna(self.floor) + both.iloc[:, 1].fillna(floor)
+        total = total.sort_values(ascending=False, kind='mergesort').astype(np.int64)
+        new_floor = self.floor + floor
+        if len(total) > self.capacity:
+            # Drop the least frequent keys, they occurred at most this often
+            new_floor = max(new_floor, int(total.iloc[self.capacity]))
+            total = total.iloc[:self.capacity]
+        self.counts = total
+        self.floor = new_floor
+
+    def update(self, counts):
+        """Add exact counts of a batch (Series indexed by the keys)."""
+        self._combine(counts[counts > 0], 0)
+        return self
+
+    def merge(self, other):
+        """Add the summary of another stream."""
+        self._combine(other.counts, other.floor)
+        return self
+
+    def top(self, k=10):
+        """Get the k keys with the highest estimated counts as (key, count) pairs."""
+        return list(self.counts.iloc[:k].items())
+
+
+def route_counts(df):
+    """Count the trips of a dataframe by (start, end) station names."""
+    start, end, stations = datastore.station_codes(df)
+    od = ODMatrix.from_codes(start, end, stations)
+    rows = od._rows()
+    index = pd.MultiIndex.from_arrays([np.asarray(stations[rows], dtype=object),
+                                       np.asarray(stations[od.indices], dtype=object)],
+                                      names=['Start Station', 'End Station'])
+    return pd.Series(od.counts, index=index)
+
+
+def top_trips(df, k=10):
+    """Get the k most popular trips of a dataframe exactly.
+    INPUTS:
+        df - the filtered dataframe
+        k (int) - number of trips to return
+    OUTPUTS:
+        routes (list) - Route(start, end, count) tuples, most frequent first
+    """
+    return ODMatrix.from_frame(df).top(k)
+
+
+def popular_trip(df):
+    """Get the most popular trip of a dataframe as a Route(start, end, count)."""
+    return ODMatrix.from_frame(df).mode()
+
+
+def approximate_top_trips(chunks, k=10, capacity=10000):
+    """Get the most popular trips of a stream of dataframes in bounded memory.
+    INPUTS:
+        chunks - iterable of dataframes of trips
+        k (int) - number of trips to return
+        capacity (int) - number of routes tracked, at least k
+    OUTPUTS:
+        routes (list) - Route(start, end, count) tuples, most frequent first;
+            counts over-estimate the true counts by at most the summary floor
+    """
+    summary = SpaceSaving(max(capacity, k))
+    for chunk in chunks:
+        summary.update(route_counts(chunk))
+    return [Route(start, end, count) for (start, end), count in summary.top(k)]
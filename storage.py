@@ -0,0 +1,312 @@
+"""Where the trips of a city are stored, and the queries run on them.
+
+The cities and their files are listed in cities.json (or the file named by
+BIKESHARE_CITIES); the extension of a file picks its store:
+
+    .csv                the csv file with its columnar cache (see datastore)
+    .parquet            a parquet file with one row group per (month, day) bucket
+    .sqlite / .db       a SQLite database with a trips table
+
+Every store loads the trips of a month/day filter and answers the
+statistics of a filter. The parquet and SQLite stores push the filters
+(and for SQLite the counting) down to the file, only the matching rows or
+the results come into Python. Convert a csv file with:
+
+    python storage.py convert chicago.csv chicago.sqlite
+"""
+import os
+import json
+import sqlite3
+from contextlib import closing
+import numpy as np
+import pandas as pd
+
+import datastore
+import aggregates
+import profiling
+
+CITIES_PATH = os.environ.get('BIKESHARE_CITIES',
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cities.json'))
+DEFAULT_CITIES = {'chicago': 'chicago.csv',
+                  'new york city': 'new_york_city.csv',
+                  'washington': 'washington.csv'}
+
+# Columns of the SQLite trips table for the columns of the csv files
+SQL_COLUMNS = {'Start Time': 'start_time', 'End Time': 'end_time', 'Trip Duration': 'trip_duration',
+               'Start Station': 'start_station', 'End Station': 'end_station',
+               'User Type': 'user_type', 'Gender': 'gender', 'Birth Year': 'birth_year'}
+
+
+def load_cities(path=CITIES_PATH):
+    """Read the city -> data file mapping of the configuration file.
+
+    The file is a json object, e.g. {"chicago": "chicago.csv"}; the three
+    sample cities are used when it does not exist.
+    """
+    if not os.path.exists(path):
+        return dict(DEFAULT_CITIES)
+    with open(path) as f:
+        cities = json.load(f)
+    return {city.lower(): file_path for city, file_path in cities.items()}
+
+
+def _bucket_filters(month, weekday):
+    return [(column, '==', value) for column, value in (('month', month), ('weekday', weekday))
+            if value is not None]
+
+
+class Store:
+    """The data file of a city. Subclasses load the trips of a filter
+    (load), all the trips with their bucket offsets (load_indexed) and the
+    statistics of a filter (summary)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def signature(self):
+        """Size and modification time of the file, see datastore.source_signature."""
+        return datastore.source_signature(self.path)
+
+    def version(self):
+        """Identifier of the content of the file, changing whenever it changes."""
+        # Hashing a large file on every request costs more than trusting its stat
+        return '{size}-{mtime_ns}'.format(**self.signature())
+
+
+class CsvStore(Store):
+    """A city csv file, read through its columnar cache and its cube."""
+
+    def version(self):
+        """Hash of the content of the file."""
+        return datastore.dataset_version(self.path)
+
+    def load(self, month=None, weekday=None):
+        return datastore.load_frame(self.path, month, weekday)
+
+    def load_indexed(self):
+        df, meta = datastore.load_indexed(self.path)
+        return df, meta['offsets']
+
+    def summary(self, month=None, weekday=None, num_stations=10):
+        return aggregates.load_cube(self.path).rollup(month, weekday, num_stations)
+
+
+class ParquetStore(Store):
+    """A parquet file of trips sorted by (month, day of week) bucket.
+
+    Each bucket is its own row group and the file has integer month and
+    weekday columns, so a filter only reads the row groups it matches.
+    """
+
+    @classmethod
+    def write(cls, path, df, offsets):
+        """Write bucket-ordered trips (see datastore.sort_into_buckets) to a parquet file."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        df = df.copy()
+        df['weekday'] = df['day_of_week'].cat.codes
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        def write(tmp_path):
+            with pq.ParquetWriter(tmp_path, table.schema) as writer:
+                for start, stop in zip(offsets[:-1], offsets[1:]):
+                    if stop > start:
+                        writer.write_table(table.slice(start, stop - start))
+        datastore.write_atomically(path, write)
+
+    def _read(self, month, weekday, columns=None):
+        df = pd.read_parquet(self.path, columns=columns, filters=_bucket_filters(month, weekday) or None)
+        return df.drop(columns='weekday', errors='ignore').reset_index(drop=True)
+
+    def load(self, month=None, weekday=None):
+        return self._read(month, weekday)
+
+    def load_indexed(self):
+        return datastore.sort_into_buckets(self._read(None, None))
+
+    def summary(self, month=None, weekday=None, num_stations=10):
+        # Only the matching row groups are read, the counting is done on them
+        return aggregates.TripAggregate.from_frame(self._read(month, weekday)).summary(num_stations)
+
+
+class SqliteStore(Store):
+    """A SQLite database with the trips of a city in its trips table.
+
+    Times are stored as seconds since the epoch, with the month, weekday
+    (Monday is 0) and hour of the start time in their own indexed columns.
+    The statistics are computed by SQL queries.
+    """
+
+    @classmethod
+    def write(cls, path, df, offsets=None):
+        """Write trips in the schema of datastore to a SQLite database."""
+        month, weekday, hour = datastore.time_fields(df['Start Time'])
+        rows = pd.DataFrame({
+            'start_time': df['Start Time'].to_numpy(dtype='datetime64[s]').astype(np.int64),
+            # Missing end times stay NULL
+            'end_time': pd.Series(df['End Time'].to_numpy(dtype='datetime64[s]').astype(np.int64)).where(
+                df['End Time'].notna().to_numpy()),
+            'trip_duration': df['Trip Duration'].to_numpy()})
+        for column in ['Start Station', 'End Station', 'User Type', 'Gender']:
+            if column in df.columns:
+                rows[SQL_COLUMNS[column]] = df[column].astype(object).to_numpy()
+        if 'Birth Year' in df.columns:
+            rows['birth_year'] = df['Birth Year'].astype('float64').to_numpy()
+        rows['month'], rows['weekday'], rows['hour'] = month, weekday, hour
+
+        def write(tmp_path):
+            with closing(sqlite3.connect(tmp_path)) as connection:
+                rows.to_sql('trips', connection, index=False, chunksize=100000)
+                connection.execute('CREATE INDEX trips_bucket ON trips (month, weekday)')
+                connection.commit()
+        datastore.write_atomically(path, write)
+
+    def _connect(self):
+        # A connection per query, connections cannot be shared between threads
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(self.path)
+        return closing(sqlite3.connect(self.path))
+
+    def _where(self, month, weekday):
+        clauses, params = [], []
+        for column, value in (('month', month), ('weekday', weekday)):
+            if value is not None:
+                clauses.append('{} = ?'.format(column))
+                params.append(int(value))
+        return ('WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def _columns(self, connection):
+        return [row[1] for row in connection.execute('PRAGMA table_info(trips)')]
+
+    @profiling.timed('sql_load')
+    def load(self, month=None, weekday=None):
+        where, params = self._where(month, weekday)
+        with self._connect() as connection:
+            present = self._columns(connection)
+            names = {sql: column for column, sql in SQL_COLUMNS.items() if sql in present}
+            query = 'SELECT {} FROM trips {} ORDER BY rowid'.format(', '.join(names), where)
+            df = pd.read_sql_query(query, connection, params=params)
+        df = df.rename(columns=names)
+        for column in datastore.TIME_COLUMNS:
+            df[column] = pd.to_datetime(df[column], unit='s')
+        return datastore.compact_types(datastore.add_time_columns(df))
+
+    def load_indexed(self):
+        return datastore.sort_into_buckets(self.load())
+
+    @profiling.timed('sql_summary')
+    def summary(self, month=None, weekday=None, num_stations=10):
+        """Get the statistics of compute_summary with SQL queries on the filtered trips."""
+        where, params = self._where(month, weekday)
+        both = where + (' AND ' if where else 'WHERE ')
+        with self._connect() as connection:
+            present = self._columns(connection)
+
+            def query(sql, extra=()):
+                return connection.execute(sql.format(where=where, both=both), params + list(extra)).fetchall()
+
+            def mode(column):
+                # Most frequent value, the first one in order on ties, None
+                # when the column is NULL for every trip of the filter
+                rows = query('SELECT {0}, COUNT(*) AS n FROM trips {{both}} {0} IS NOT NULL '
+                             'GROUP BY {0} ORDER BY n DESC, {0} LIMIT 1'.format(column))
+                return rows[0] if rows else (None, None)
+
+            def counts(column, label):
+                rows = query('SELECT {0}, COUNT(*) AS n FROM trips {{both}} {0} IS NOT NULL '
+                             'GROUP BY {0} ORDER BY n DESC, {0}'.format(column))
+                return pd.DataFrame({label: [row[0] for row in rows], 'frequency': [row[1] for row in rows]})
+
+            trip_count, total, average, first_start, last_end = query(
+                'SELECT COUNT(*), SUM(trip_duration), AVG(trip_duration), MIN(start_time), MAX(end_time) '
+                'FROM trips {where}')[0]
+            if trip_count == 0:
+                raise ValueError('No trips to summarise')
+
+            summary = {'trip_count': trip_count}
+            summary['popular_month'], summary['popular_month_count'] = mode('month')
+            summary['popular_day_of_week'] = datastore.WEEKDAY_NAMES[mode('weekday')[0]]
+            summary['popular_hour'] = mode('hour')[0]
+            summary['popular_start_station'] = mode('start_station')[0]
+            summary['popular_end_station'] = mode('end_station')[0]
+
+            trips = query('SELECT start_station, end_station, COUNT(*) AS n FROM trips {both} '
+                          'start_station IS NOT NULL AND end_station IS NOT NULL '
+                          'GROUP BY start_station, end_station ORDER BY n DESC, start_station, end_station '
+                          'LIMIT ?', [num_stations])
+            summary['popular_trip'] = aggregates.trip_name(trips[0][0], trips[0][1]) if trips else np.nan
+            summary['popular_trip_stations'] = (trips[0][0], trips[0][1]) if trips else None
+            summary['popular_trips'] = pd.DataFrame({
+                'trips': [aggregates.trip_name(start, end) for start, end, _ in trips],
+                'frequency': [n for _, _, n in trips]})
+
+            summary['total_travel_time'] = total
+            summary['average_time'] = average
+            # The duration of rank q * (count - 1), like bikeshare.compute_summary
+            # None percentiles and missing extremes when no trip of the filter has a duration
+            with_duration = query('SELECT COUNT(trip_duration) FROM trips {where}')[0][0]
+            summary['duration_percentiles'] = {
+                aggregates.percentile_name(quantile): query(
+                    'SELECT trip_duration FROM trips {both} trip_duration IS NOT NULL '
+                    'ORDER BY trip_duration LIMIT 1 OFFSET ?', [int(quantile * (with_duration - 1))])[0][0]
+                if with_duration else None
+                for quantile in aggregates.QUANTILES}
+            for name, direction in (('longest', 'DESC'), ('fastest', 'ASC')):
+                rows = query(
+                    'SELECT trip_duration, start_station, end_station FROM trips {{both}} trip_duration IS NOT NULL '
+                    'ORDER BY trip_duration {}, rowid LIMIT 1'.format(direction))
+                duration, start, end = rows[0] if rows else (np.nan, None, None)
+                summary['{}_trip_duration'.format(name)] = duration
+                summary['{}_trip'.format(name)] = aggregates.trip_name(start, end) if rows else np.nan
+
+            summary['user_types'] = counts('user_type', 'user_types')
+            summary['earliest_usage'] = pd.Timestamp(first_start, unit='s')
+            summary['most_recent_usage'] = pd.Timestamp(last_end, unit='s') if last_end is not None else pd.NaT
+
+            summary.update({'gender': None, 'popular_birth_year': None,
+                            'popular_birth_year_count': None, 'average_birth_year': None})
+            if 'gender' in present:
+                summary['gender'] = counts('gender', 'gender')
+            if 'birth_year' in present:
+                average_year = query('SELECT AVG(birth_year) FROM trips {where}')[0][0]
+                if average_year is not None:
+                    year, count = mode('CAST(birth_year AS INTEGER)')
+                    summary.update({'popular_birth_year': int(year), 'popular_birth_year_count': count,
+                                    'average_birth_year': average_year})
+        return summary
+
+
+STORES = {'.csv': CsvStore, '.parquet': ParquetStore, '.sqlite': SqliteStore, '.db': SqliteStore}
+
+
+def open_store(path):
+    """Get the store of a city data file, after its extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in STORES:
+        raise ValueError('No store for {!r} files, use one of {}'.format(extension, list(STORES)))
+    return STORES[extension](path)
+
+
+def convert(csv_path, target_path):
+    """Write the trips of a city csv file to a parquet file or a SQLite database."""
+    store = open_store(target_path)
+    if isinstance(store, (ParquetStore, SqliteStore)):
+        df, meta = datastore.load_indexed(csv_path)
+        type(store).write(target_path, df, meta['offsets'])
+    else:
+        raise ValueError('Convert to a .parquet, .sqlite or .db file')
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a city csv file to another store.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    conversion = commands.add_parser('convert', help="write a csv file as parquet or SQLite")
+    conversion.add_argument('csv_path')
+    conversion.add_argument('target_path', help="path of the .parquet, .sqlite or .db file to write")
+    args = parser.parse_args()
+
+    convert(args.csv_path, args.target_path)
+    print('Wrote {}, add it to {} to use it.'.format(args.target_path, CITIES_PATH))
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the app sit at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+
+@pytest.fixture
+def city_csv(tmp_path):
+    """A small synthetic city csv file with the columns of Chicago."""
+    path = str(tmp_path / 'city.csv')
+    benchmark.generate_trips(path, 2000)
+    return path
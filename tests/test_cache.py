@@ -0,0 +1,66 @@
+import os
+
+import bikeshare
+import cache
+
+
+def test_results_kept_in_memory_when_cache_folder_unwritable(city_csv, monkeypatch):
+    # A plain file where the .cache folder should be: nothing can be written under it
+    cache_folder = cache.datastore.cache_folder(city_csv)
+    with open(cache_folder, 'w'):
+        pass
+    monkeypatch.setitem(bikeshare.CITY_DATA, 'unwritable', city_csv)
+
+    results = cache.ResultCache(persist=True)
+    calls = []
+
+    @results.memoize
+    def trip_count(city, month, day):
+        calls.append((city, month, day))
+        return len(bikeshare.load_data(city, month, day))
+
+    first = trip_count('unwritable', 'march', 'all')
+    assert trip_count('unwritable', 'march', 'all') == first
+    assert len(calls) == 1
+    assert results.stats()['hits'] == 1
+    # No result folder and no temporary file left behind
+    assert [name for name in os.listdir(os.path.dirname(city_csv)) if name.endswith('.tmp')] == []
+
+
+def test_summary_when_cache_folder_unwritable(city_csv, monkeypatch):
+    with open(cache.datastore.cache_folder(city_csv), 'w'):
+        pass
+    monkeypatch.setitem(bikeshare.CITY_DATA, 'unwritable', city_csv)
+    assert cache.summary('unwritable', 'all', 'all')['trip_count'] == 2000
+
+
+def test_prefetcher_forgets_finished_owners(monkeypatch):
+    prefetcher = cache.Prefetcher(cache.DATASETS, max_workers=1)
+    monkeypatch.setattr(prefetcher, '_tasks', lambda city, month, day: [(lambda: None,)])
+
+    for owner in range(5):
+        prefetcher.schedule('chicago', 'all', 'all', owner=owner)
+        prefetcher._executor.submit(lambda: None).result()
+    prefetcher.schedule('chicago', 'all', 'all', owner='last')
+
+    assert list(prefetcher._pending) == list(prefetcher._generations) == ['last']
+    prefetcher._executor.shutdown(wait=True)
+    assert prefetcher.stats()['done'] == 6
+
+
+def test_dataset_version_hashes_once_when_cache_folder_unwritable(city_csv, monkeypatch):
+    with open(cache.datastore.cache_folder(city_csv), 'w'):
+        pass
+    hashed = []
+    file_digest = cache.datastore.file_digest
+    monkeypatch.setattr(cache.datastore, 'file_digest', lambda *args: hashed.append(args) or file_digest(*args))
+
+    version = cache.datastore.dataset_version(city_csv)
+    assert cache.datastore.dataset_version(city_csv) == version
+    assert len(hashed) == 1
+
+    # A new version of the file is hashed again
+    with open(city_csv, 'a') as f:
+        f.write('\n')
+    assert cache.datastore.dataset_version(city_csv) != version
+    assert len(hashed) == 2
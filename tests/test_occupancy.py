@@ -0,0 +1,18 @@
+import pandas as pd
+
+import occupancy
+
+
+def test_station_flow_leaves_out_invalid_times():
+    df = pd.DataFrame({
+        'Start Time': pd.to_datetime(['2017-03-01 08:10', '2017-03-01 08:20', '2017-03-01 09:05',
+                                      '2017-03-01 09:30']),
+        'End Time': pd.to_datetime(['2017-03-01 08:40', None, '2017-03-01 08:55', '2017-03-01 10:15']),
+        'Start Station': ['A', 'B', 'A', 'B'],
+        'End Station': ['B', 'A', 'B', 'A']})
+
+    flow = occupancy.station_flow(df, 'hour')
+    # Only the first and last trips have a valid start and end
+    assert flow['time'].min() == pd.Timestamp('2017-03-01 08:00')
+    assert flow['departures'].sum() == flow['arrivals'].sum() == 2
+    assert flow['net'].sum() == 0
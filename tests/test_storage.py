@@ -0,0 +1,22 @@
+import math
+
+import datastore
+import storage
+
+
+def test_sqlite_summary_without_durations(city_csv, tmp_path):
+    df, _ = datastore.load_indexed(city_csv)
+    # No trip of March has a duration
+    df.loc[df['Start Time'].dt.month == 3, 'Trip Duration'] = float('nan')
+    path = str(tmp_path / 'city.sqlite')
+    storage.SqliteStore.write(path, df)
+
+    summary = storage.open_store(path).summary(month=3)
+    assert summary['trip_count'] == (df['Start Time'].dt.month == 3).sum()
+    assert set(summary['duration_percentiles'].values()) == {None}
+    for name in ('longest', 'fastest'):
+        assert math.isnan(summary['{}_trip_duration'.format(name)])
+        assert math.isnan(summary['{}_trip'.format(name)])
+
+    # The other months keep their durations
+    assert storage.open_store(path).summary(month=4)['longest_trip_duration'] > 0
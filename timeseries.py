@@ -0,0 +1,113 @@
+"""Trips and durations over time, at a fixed granularity.
+
+The timestamps are turned into integer bucket numbers (seconds since the
+epoch divided by the bucket width) once, then every curve is a bincount
+over the buckets; nothing is grouped by datetime objects.
+"""
+import numpy as np
+import pandas as pd
+
+import datastore
+import profiling
+
+# Width of the buckets of every granularity, in seconds
+FREQUENCIES = {'15min': 15 * 60, 'hour': 3600, 'day': 86400, 'week': 7 * 86400}
+# Weeks start on Monday, 1970-01-01 (the epoch) was a Thursday
+WEEK_ORIGIN = -3 * 86400
+
+
+def _origin(freq):
+    return WEEK_ORIGIN if freq == 'week' else 0
+
+
+def epoch_buckets(times, freq='hour'):
+    """Get the bucket number of datetime64 values at a granularity.
+    INPUTS:
+        times - datetime64 values (Pandas Series or numpy array), no missing value
+        freq (str) - one of FREQUENCIES
+    OUTPUTS:
+        buckets (array) - int64 bucket numbers, bucket b starts at
+            bucket_starts(b, freq)
+    """
+    if freq not in FREQUENCIES:
+        raise ValueError('Unknown granularity {!r}, use one of {}'.format(freq, list(FREQUENCIES)))
+    seconds = np.asarray(times, dtype='datetime64[s]').astype(np.int64)
+    return np.floor_divide(seconds - _origin(freq), FREQUENCIES[freq])
+
+
+def bucket_starts(buckets, freq='hour'):
+    """Get the start time of bucket numbers as a DatetimeIndex."""
+    seconds = np.asarray(buckets, dtype=np.int64) * FREQUENCIES[freq] + _origin(freq)
+    return pd.DatetimeIndex(seconds.astype('datetime64[s]').astype('datetime64[ns]'), name='time')
+
+
+@profiling.timed()
+def rollup(df, freq='hour', by_user_type=False, column='Start Time'):
+    """Get the trips and their durations per time bucket.
+
+    Every bucket between the first and the last trip is present, with zero
+    trips when nothing happened.
+    INPUTS:
+        df - dataframe of trips
+        freq (str) - granularity, one of '15min', 'hour', 'day' and 'week'
+        by_user_type (bool) - add the number of trips of every user type
+        column (str) - timestamp placing the trips in time, Start Time or End Time
+    OUTPUTS:
+        curves - dataframe indexed by the start of the buckets, with the trips,
+            duration_total and duration_mean columns (and one column per user type)
+    """
+    buckets = epoch_buckets(df[column], freq)
+    if len(buckets) == 0:
+        return pd.DataFrame({'trips': [], 'duration_total': [], 'duration_mean': []},
+                            index=bucket_starts([], freq))
+    first = buckets.min()
+    position = buckets - first
+    size = int(position.max()) + 1
+
+    durations = np.nan_to_num(df['Trip Duration'].to_numpy(dtype=np.float64))
+    trips = np.bincount(position, minlength=size)
+    totals = np.bincount(position, weights=durations, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # NaN for the buckets without any trip
+        means = totals / trips
+
+    curves = pd.DataFrame({'trips': trips, 'duration_total': totals, 'duration_mean': means},
+                          index=bucket_starts(np.arange(first, first + size), freq))
+    if by_user_type and 'User Type' in df.columns:
+        codes, user_types = datastore.category_codes(df['User Type'])
+        valid = codes >= 0
+        counts = np.bincount(position[valid] * len(user_types) + codes[valid],
+                             minlength=size * len(user_types)).reshape(size, len(user_types))
+        for i, user_type in enumerate(user_types):
+            curves[user_type] = counts[:, i]
+    return curves
+
+
+def rolling(curves, window):
+    """Sum the curves of rollup over trailing windows of buckets.
+
+    The counts and the total duration are summed over the window ending at
+    each bucket (shorter at the start), the mean duration is the mean of
+    the trips of the window.
+    INPUTS:
+        curves - dataframe returned by rollup
+        window (int) - number of buckets of the windows, e.g. 24 hourly buckets
+    OUTPUTS:
+        curves - dataframe with the same index and columns
+    """
+    if window < 1:
+        raise ValueError('The window must hold at least one bucket')
+    summed = [name for name in curves.columns if name != 'duration_mean']
+    values = curves[summed].to_numpy(dtype=np.float64)
+    # Window sums as differences of cumulative sums
+    cumulative = np.vstack([np.zeros((1, len(summed))), np.cumsum(values, axis=0)])
+    ends = np.arange(1, len(curves) + 1)
+    sums = cumulative[ends] - cumulative[np.maximum(ends - window, 0)]
+
+    windows = pd.DataFrame(sums, index=curves.index, columns=summed)
+    for name in summed:
+        if name != 'duration_total':
+            windows[name] = windows[name].round().astype(np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        windows['duration_mean'] = windows['duration_total'] / windows['trips']
+    return windows[curves.columns]